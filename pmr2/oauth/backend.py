@@ -0,0 +1,180 @@
+import socket
+import threading
+import SocketServer
+from hashlib import sha1
+
+import zope.interface
+
+from pmr2.oauth.interfaces import IKeyValueStore
+from pmr2.oauth.cache import LRUCache
+
+
+def storeKey(*parts):
+    """\
+    Build a key safe for use with the stores from parts, as the client
+    keys and nonces may contain characters (e.g. spaces) that are not.
+    """
+
+    raw = '\0'.join([unicode(p).encode('utf-8') for p in parts])
+    return 'pmr2.oauth:' + sha1(raw).hexdigest()
+
+
+class LocalStore(object):
+    """\
+    Key-value store within the memory of the current process.
+    """
+
+    zope.interface.implements(IKeyValueStore)
+
+    def __init__(self, maxsize=100000):
+        self._cache = LRUCache(maxsize=maxsize)
+
+    def add(self, key, value, ttl=0):
+        return self._cache.add(key, value, ttl or None)
+
+    def set(self, key, value, ttl=0):
+        self._cache.set(key, value, ttl or None)
+        return True
+
+    def get(self, key, default=None):
+        return self._cache.get(key, default)
+
+    def delete(self, key):
+        return self._cache.pop(key, None) is not None
+
+
+class MemcachedStore(object):
+    """\
+    Key-value store client speaking the memcached text protocol, one
+    connection per thread.
+    """
+
+    zope.interface.implements(IKeyValueStore)
+
+    def __init__(self, address='127.0.0.1:11211', timeout=3.0):
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection(self.address, self.timeout)
+            conn = (sock, sock.makefile('rb'))
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            sock, fp = conn
+            fp.close()
+            sock.close()
+
+    def _call(self, command, data=None):
+        sock, fp = self._connection()
+        if data is not None:
+            command = '%s %d\r\n%s' % (command, len(data), data)
+        try:
+            sock.sendall(command + '\r\n')
+            line = fp.readline()
+            if not line:
+                raise socket.error('connection closed by server')
+            if not line.startswith('VALUE '):
+                return line.rstrip('\r\n'), None
+            length = int(line.split()[3])
+            value = fp.read(length + 2)[:-2]
+            # the END marker
+            fp.readline()
+            return 'VALUE', value
+        except Exception:
+            # the state of the connection is now unknown.
+            self.close()
+            raise
+
+    def _store(self, cmd, key, value, ttl):
+        result, _ = self._call('%s %s 0 %d' % (cmd, key, int(ttl)), value)
+        return result == 'STORED'
+
+    def add(self, key, value, ttl=0):
+        return self._store('add', key, value, ttl)
+
+    def set(self, key, value, ttl=0):
+        return self._store('set', key, value, ttl)
+
+    def get(self, key, default=None):
+        result, value = self._call('get %s' % key)
+        if result != 'VALUE':
+            return default
+        return value
+
+    def delete(self, key):
+        result, _ = self._call('delete %s' % key)
+        return result == 'DELETED'
+
+
+class _StandInHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = line.split()
+            if not args:
+                continue
+            cmd = args[0]
+            if cmd in ('add', 'set'):
+                key, ttl, length = args[1], int(args[3]), int(args[4])
+                value = self.rfile.read(length + 2)[:-2]
+                stored = getattr(store, cmd)(key, value, ttl)
+                self.wfile.write(stored and 'STORED\r\n' or
+                    'NOT_STORED\r\n')
+            elif cmd == 'get':
+                value = store.get(args[1])
+                if value is not None:
+                    self.wfile.write('VALUE %s 0 %d\r\n%s\r\n' % (
+                        args[1], len(value), value))
+                self.wfile.write('END\r\n')
+            elif cmd == 'delete':
+                deleted = store.delete(args[1])
+                self.wfile.write(deleted and 'DELETED\r\n' or
+                    'NOT_FOUND\r\n')
+            elif cmd == 'quit':
+                return
+            else:
+                self.wfile.write('ERROR\r\n')
+
+
+class StandInServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """\
+    A pure Python server implementing the subset of the memcached text
+    protocol used by MemcachedStore, backed by a LocalStore.  Meant as a
+    stand-in for testing and development only.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        SocketServer.TCPServer.__init__(self, (host, port), _StandInHandler)
+        self.store = LocalStore()
+        self._thread = None
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
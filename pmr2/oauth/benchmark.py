@@ -0,0 +1,546 @@
+"""\
+Benchmark for the OAuth 1.0a dance and the validation of the requests
+for protected resources, run against an in-memory ZODB.
+
+Usage::
+
+    bin/pmr2_oauth_benchmark --iterations 500 --consumers 100
+
+Alternatively, the rate of the conflicts on concurrent insertions into
+the token trees can be measured, unsharded and sharded::
+
+    bin/pmr2_oauth_benchmark --conflicts --concurrency 1,4,16
+
+The results are written as JSON.
+"""
+
+import sys
+import math
+import time
+import json
+import random
+from optparse import OptionParser
+from urlparse import parse_qsl
+from cStringIO import StringIO
+
+import transaction
+from BTrees.OOBTree import OOBTree
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import ConflictError
+
+import zope.component
+import zope.interface
+from zope.annotation.attribute import AttributeAnnotations
+from zope.annotation.interfaces import IAnnotatable, IAttributeAnnotatable
+from zope.component.hooks import setSite
+from zope.publisher.browser import TestRequest
+
+from Acquisition import Implicit, aq_base, aq_inner, aq_parent
+from OFS.Folder import Folder
+from OFS.SimpleItem import SimpleItem
+
+from oauthlib.oauth1 import Client
+
+from pmr2.oauth.interfaces import IOAuthRequestValidatorAdapter
+from pmr2.oauth.interfaces import IConsumerManager, ITokenManager
+from pmr2.oauth.interfaces import IScopeManager, IContentTypeScopeManager
+from pmr2.oauth.interfaces import INonceManager, ICallbackManager
+from pmr2.oauth.callback import CallbackManager
+from pmr2.oauth.consumer import Consumer, ConsumerManagerFactory
+from pmr2.oauth.nonce import NonceManagerFactory
+from pmr2.oauth.scope import ContentTypeScopeManagerFactory
+from pmr2.oauth.token import TokenManagerFactory
+from pmr2.oauth.plugins.oauth import OAuthPlugin
+from pmr2.oauth.browser.token import RequestTokenPage, GetAccessTokenPage
+from pmr2.oauth.browser.token import AuthorizeTokenForm
+from pmr2.oauth.utility import SiteRequestValidatorAdapter, random_string
+from pmr2.oauth.shard import ShardedOOBTree
+
+timer = time.time
+
+
+def setUpComponents():
+    """\
+    Register the managers for the site, as done by adapter.zcml.
+    """
+
+    site = (IAnnotatable, zope.interface.Interface)
+    zope.component.provideAdapter(AttributeAnnotations)
+    zope.component.provideAdapter(SiteRequestValidatorAdapter, site,
+        IOAuthRequestValidatorAdapter)
+    zope.component.provideAdapter(ConsumerManagerFactory, site,
+        IConsumerManager)
+    zope.component.provideAdapter(TokenManagerFactory, site, ITokenManager)
+    zope.component.provideAdapter(ContentTypeScopeManagerFactory, site,
+        IContentTypeScopeManager)
+    zope.component.provideAdapter(NonceManagerFactory, site, INonceManager)
+    zope.component.provideAdapter(CallbackManager,
+        (zope.interface.Interface, zope.interface.Interface),
+        ICallbackManager)
+
+
+class BenchmarkRequest(TestRequest):
+
+    zope.interface.implements(IAttributeAnnotatable)
+
+    def __init__(self, url, method='GET', **kw):
+        parts = url.split('?', 1)[0].split('/')
+        super(BenchmarkRequest, self).__init__(**kw)
+        self._app_server = '/'.join(parts[:3])
+        self._app_names = parts[3:]
+        self.other = {'ACTUAL_URL': self.getURL()}
+        self._environ['ACTUAL_URL'] = self.getURL()
+        self.stdin = StringIO()
+        self.method = method
+
+
+class TypeInfo(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class TypesTool(SimpleItem):
+
+    id = 'portal_types'
+
+    def getTypeInfo(self, context):
+        portal_type = getattr(aq_base(context), 'portal_type', None)
+        return portal_type and TypeInfo(portal_type) or None
+
+
+class Member(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class MembershipTool(SimpleItem):
+
+    id = 'portal_membership'
+    userid = None
+
+    def isAnonymousUser(self):
+        return self.userid is None
+
+    def getAuthenticatedMember(self):
+        return Member(self.userid)
+
+
+class Site(Folder):
+
+    zope.interface.implements(IAttributeAnnotatable)
+
+    portal_type = 'Plone Site'
+
+    def getSiteManager(self):
+        return zope.component.getGlobalSiteManager()
+
+    def absolute_url(self):
+        return 'http://nohost/' + self.getId()
+
+
+class PAS(Implicit):
+    """\
+    Just enough of PAS for the plugin to look up the accessed object.
+    """
+
+    def _getObjectContext(self, published, request):
+        accessed = aq_inner(published)
+        return accessed, aq_parent(accessed), request.published_name, None
+
+
+class Benchmark(object):
+    """\
+    Sets up a site with the specified number of consumers, users with
+    access tokens and scope mapping entries, then times each of the
+    steps of the OAuth dance.
+    """
+
+    def __init__(self, consumers=10, users=10, tokens_per_user=10,
+            mapping_size=10, depth=3, seed=None):
+        self.consumers = consumers
+        self.users = users
+        self.tokens_per_user = tokens_per_user
+        self.mapping_size = mapping_size
+        self.depth = depth
+        self.random = random.Random(seed)
+
+    def config(self):
+        return {
+            'consumers': self.consumers,
+            'users': self.users,
+            'tokens_per_user': self.tokens_per_user,
+            'mapping_size': self.mapping_size,
+            'depth': self.depth,
+        }
+
+    def _manager(self, iface):
+        return zope.component.getMultiAdapter(
+            (self.site, BenchmarkRequest(self.site.absolute_url())), iface)
+
+    def setUp(self):
+        setUpComponents()
+        self.db = DB(MappingStorage())
+        self.conn = self.db.open()
+        root = self.conn.root()
+
+        site = Site('site')
+        site._setObject('portal_types', TypesTool())
+        site._setObject('portal_membership', MembershipTool())
+        root['site'] = site
+        transaction.commit()
+        self.site = site = root['site']
+        setSite(site)
+
+        # the content being accessed, at the specified depth.
+        container = site
+        for i in range(self.depth):
+            container._setObject('folder', Folder('folder'))
+            container = container.folder
+            container.portal_type = 'Folder'
+        self.content = container
+
+        sm = self._manager(IScopeManager)
+        patterns = ['view_%d' % i for i in range(self.mapping_size - 1)]
+        sm.default_mapping_id = sm.addMapping({
+            'Plone Site': patterns + ['view'],
+            'Folder': patterns + ['view'],
+        })
+
+        cm = self._manager(IConsumerManager)
+        self.consumer_list = []
+        for i in range(self.consumers):
+            consumer = Consumer(random_string(24), random_string(24),
+                domain=u'nohost')
+            cm.add(consumer)
+            self.consumer_list.append(consumer)
+
+        # the access tokens for the users.
+        tm = self._manager(ITokenManager)
+        self.access_tokens = []
+        for i in range(self.users):
+            user = 'user%d' % i
+            for j in range(self.tokens_per_user):
+                consumer = self.random.choice(self.consumer_list)
+                token = tm.generateRequestToken(consumer.key, 'oob')
+                sm.requestScope(token.key, None)
+                tm.claimRequestToken(token, user)
+                access = tm.generateAccessToken(consumer.key, token.key)
+                sm.setAccessScope(access.key, sm.popScope(token.key))
+                tm.remove(token)
+                self.access_tokens.append((consumer, access))
+
+        transaction.commit()
+
+    def tearDown(self):
+        transaction.abort()
+        setSite(None)
+        self.conn.close()
+        self.db.close()
+
+    def signedRequest(self, url, consumer, token=None, verifier=None,
+            callback=None):
+        client = Client(
+            unicode(consumer.key),
+            unicode(consumer.secret),
+            token and unicode(token.key),
+            token and unicode(token.secret),
+            callback and unicode(callback),
+            verifier=verifier and unicode(verifier),
+        )
+        uri, headers, body = client.sign(unicode(url), u'GET')
+        request = BenchmarkRequest(url)
+        request._auth = headers['Authorization']
+        return request
+
+    def _time(self, call, requests):
+        latencies = []
+        results = []
+        for request in requests:
+            start = timer()
+            results.append(call(request))
+            transaction.commit()
+            latencies.append(timer() - start)
+        return latencies, results
+
+    def requestToken(self, iterations):
+        url = self.site.absolute_url() + '/OAuthRequestToken'
+        consumers = [self.random.choice(self.consumer_list)
+            for i in range(iterations)]
+        requests = [self.signedRequest(url, consumer, callback='oob')
+            for consumer in consumers]
+
+        def call(request):
+            return RequestTokenPage(self.site, request)()
+
+        latencies, results = self._time(call, requests)
+        self.request_tokens = [(consumer, dict(parse_qsl(result)))
+            for consumer, result in zip(consumers, results)]
+        return latencies
+
+    def claimToken(self, iterations):
+        """\
+        A partial stand-in for the approval of the request tokens by the
+        users through the AuthorizeTokenForm, which is not rendered nor
+        processed here as that requires a full Plone site.  Only the
+        token and consumer lookups and the claim of the token done by
+        the form are timed, without the rendering of the scope or the
+        processing of the form itself.
+        """
+
+        url = self.site.absolute_url() + '/OAuthAuthorizeToken'
+        requests = []
+        for consumer, qs in self.request_tokens[:iterations]:
+            request = BenchmarkRequest(url, form={
+                'oauth_token': qs['oauth_token']})
+            requests.append(request)
+
+        self.site.portal_membership.userid = 'user0'
+
+        def call(request):
+            form = AuthorizeTokenForm(self.site, request)
+            token = form._checkToken(request.form['oauth_token'])
+            form._checkConsumer(token.consumer_key)
+            user = form.context.portal_membership.getAuthenticatedMember()
+            tm = zope.component.getMultiAdapter((self.site, request),
+                ITokenManager)
+            tm.claimRequestToken(token, user.id)
+            return token
+
+        latencies, results = self._time(call, requests)
+        self.verified_tokens = [(consumer, token) for (consumer, qs), token
+            in zip(self.request_tokens, results)]
+        return latencies
+
+    def accessToken(self, iterations):
+        url = self.site.absolute_url() + '/OAuthGetAccessToken'
+        requests = [self.signedRequest(url, consumer, token=token,
+                verifier=token.verifier)
+            for consumer, token in self.verified_tokens[:iterations]]
+
+        def call(request):
+            return GetAccessTokenPage(self.site, request)()
+
+        return self._time(call, requests)[0]
+
+    def protectedResource(self, iterations):
+        plugin = OAuthPlugin('oauth').__of__(PAS().__of__(self.site))
+        url = '/'.join((self.site.absolute_url(),) +
+            self.content.getPhysicalPath()[1:] + ('view',))
+        requests = []
+        for i in range(iterations):
+            consumer, token = self.random.choice(self.access_tokens)
+            request = self.signedRequest(url, consumer, token=token)
+            request.PUBLISHED = self.content
+            request.published_name = 'view'
+            requests.append(request)
+
+        def call(request):
+            result = plugin.extractCredentials(request)
+            if not result:
+                raise ValueError('credentials not extracted')
+            return result
+
+        return self._time(call, requests)[0]
+
+    def run(self, iterations=100):
+        self.setUp()
+        try:
+            results = {}
+            for name, step in (
+                    ('request_token', self.requestToken),
+                    ('claim_token', self.claimToken),
+                    ('access_token', self.accessToken),
+                    ('protected_resource', self.protectedResource),
+                    ):
+                results[name] = summarize(step(iterations))
+        finally:
+            self.tearDown()
+
+        return {
+            'config': self.config(),
+            'iterations': iterations,
+            'results': results,
+        }
+
+
+def conflictRate(shards, concurrency, rounds=50, inserts=1, prefill=2000,
+        seed=None):
+    """\
+    Measure the conflicts of concurrent insertions into a token tree,
+    with shards number of trees (a plain OOBTree for 1).
+
+    For each round, concurrency number of connections each insert the
+    given number of keys into the tree before they are all committed,
+    as concurrent transactions would be.  Returns the number of commits
+    and the number of the conflicts that could not be resolved.
+    """
+
+    rand = random.Random(seed)
+    key = lambda: '%024x' % rand.getrandbits(96)
+    db = DB(MappingStorage(), pool_size=concurrency + 1)
+    try:
+        conn = db.open()
+        if shards > 1:
+            tree = ShardedOOBTree(shards)
+        else:
+            tree = OOBTree()
+        for i in range(prefill):
+            tree[key()] = None
+        conn.root()['tree'] = tree
+        transaction.commit()
+        conn.close()
+
+        commits = conflicts = 0
+        for r in range(rounds):
+            pending = []
+            for c in range(concurrency):
+                tm = transaction.TransactionManager()
+                conn = db.open(transaction_manager=tm)
+                tree = conn.root()['tree']
+                for i in range(inserts):
+                    tree[key()] = None
+                pending.append((tm, conn))
+
+            for tm, conn in pending:
+                try:
+                    tm.commit()
+                    commits += 1
+                except ConflictError:
+                    tm.abort()
+                    conflicts += 1
+                conn.close()
+    finally:
+        db.close()
+
+    rate = None
+    if commits + conflicts:
+        rate = float(conflicts) / (commits + conflicts)
+    return {
+        'commits': commits,
+        'conflicts': conflicts,
+        'conflict_rate': rate,
+    }
+
+
+def conflictRates(concurrency=(1, 2, 4, 8, 16), shards=(1, 16), rounds=50,
+        inserts=1, prefill=2000, seed=None):
+    results = {}
+    for count in shards:
+        results[str(count)] = rates = {}
+        for level in concurrency:
+            rates[str(level)] = conflictRate(count, level, rounds, inserts,
+                prefill, seed)
+    return {
+        'config': {
+            'rounds': rounds,
+            'inserts': inserts,
+            'prefill': prefill,
+            'seed': seed,
+        },
+        'shards': results,
+    }
+
+
+def percentile(values, p):
+    """\
+    The nearest-rank percentile of the sorted values.
+    """
+
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def summarize(latencies):
+    """\
+    The throughput (per second) and latencies (in milliseconds) of the
+    timed requests.
+    """
+
+    values = sorted(latencies)
+    count = len(values)
+    total = sum(values)
+    result = {
+        'count': count,
+        'total': total,
+        'throughput': None,
+        'latency_ms': None,
+    }
+    if not count:
+        return result
+
+    if total:
+        result['throughput'] = count / total
+    result['latency_ms'] = {
+        'mean': total / count * 1000,
+        'p50': percentile(values, 50) * 1000,
+        'p90': percentile(values, 90) * 1000,
+        'p99': percentile(values, 99) * 1000,
+        'max': values[-1] * 1000,
+    }
+    return result
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--iterations', type='int', default=100,
+        help='number of requests timed for each step [%default]')
+    parser.add_option('-c', '--consumers', type='int', default=10,
+        help='number of consumers [%default]')
+    parser.add_option('-u', '--users', type='int', default=10,
+        help='number of users with access tokens [%default]')
+    parser.add_option('-t', '--tokens-per-user', type='int', default=10,
+        help='number of access tokens for each user [%default]')
+    parser.add_option('-m', '--mapping-size', type='int', default=10,
+        help='number of subpaths for each type in the scope [%default]')
+    parser.add_option('-d', '--depth', type='int', default=3,
+        help='depth of the accessed object within the site [%default]')
+    parser.add_option('-s', '--seed', type='int', default=None,
+        help='seed for the random choices')
+    parser.add_option('-o', '--output', default=None,
+        help='write the results to this file instead of stdout')
+    parser.add_option('--conflicts', action='store_true', default=False,
+        help='measure the conflicts of concurrent token insertions instead')
+    parser.add_option('--concurrency', default='1,2,4,8,16',
+        help='concurrent transactions measured for conflicts [%default]')
+    parser.add_option('--shards', default='1,16',
+        help='numbers of shards measured for conflicts [%default]')
+    parser.add_option('--rounds', type='int', default=50,
+        help='rounds of concurrent transactions [%default]')
+    options, args = parser.parse_args(argv)
+
+    if options.conflicts:
+        results = conflictRates(
+            concurrency=[int(i) for i in options.concurrency.split(',')],
+            shards=[int(i) for i in options.shards.split(',')],
+            rounds=options.rounds,
+            seed=options.seed,
+        )
+    else:
+        benchmark = Benchmark(
+            consumers=options.consumers,
+            users=options.users,
+            tokens_per_user=options.tokens_per_user,
+            mapping_size=options.mapping_size,
+            depth=options.depth,
+            seed=options.seed,
+        )
+        results = benchmark.run(options.iterations)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(output)
+        finally:
+            f.close()
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -1,3 +1,5 @@
+from urllib import urlencode
+
 import zope.component
 import zope.interface
 from zope.publisher.browser import BrowserPage
@@ -15,6 +17,7 @@ from pmr2.oauth.interfaces import *
 from pmr2.oauth.browser.template import ViewPageTemplateFile
 from pmr2.oauth.browser.template import path
 from pmr2.oauth.utility import random_string
+from pmr2.oauth.maintenance import revokeTokens
 
 from pmr2.oauth.consumer import Consumer
 
@@ -29,6 +32,7 @@ class ConsumerAddForm(form.AddForm):
         # secret should be generated.
         'title',
         'domain',
+        'rsa_key',
     )
 
     def update(self):
@@ -41,7 +45,8 @@ class ConsumerAddForm(form.AddForm):
         data['key'] = key = random_string(24)
         data['secret'] = secret = random_string(24)
         self._data = data
-        return Consumer(key, secret, data['title'], data['domain'])
+        return Consumer(key, secret, data['title'], data['domain'],
+            data.get('rsa_key'))
 
     def add(self, obj):
         cm = zope.component.getMultiAdapter(
@@ -60,21 +65,41 @@ class ConsumerManageForm(form.PostForm):
     ignoreContext = True
     template = ViewPageTemplateFile(path('consumer_manage_token.pt'))
 
+    # number of consumers listed on each page.
+    batch_size = 50
+
     def getConsumers(self):
         cm = zope.component.getMultiAdapter((self.context, self.request),
             IConsumerManager)
-        keys = cm.getAllKeys()
 
         # TODO rather than listing all secrets with this form, make it
         # so it will be possible to review the keys on a per-consumer
         # basis along with any fields specific to one.
 
-        consumers = [cm.get(k) for k in keys]
+        # Only the consumers on the requested page are loaded.
+        start = self.request.form.get('start') or None
+        consumers, self.next_start = cm.getConsumerPage(start,
+            self.batch_size)
+        self.start = start
         return consumers
 
+    @property
+    def next_url(self):
+        if self.next_start is None:
+            return None
+        return '%s/%s?%s' % (self.context.absolute_url(), self.__name__,
+            urlencode({'start': self.next_start}))
+
+    def getTokenCounts(self, consumers):
+        tm = zope.component.getMultiAdapter((self.context, self.request),
+            ITokenManager)
+        return dict([(c.key, tm.countTokensForConsumer(c.key))
+            for c in consumers])
+
     def update(self):
         super(ConsumerManageForm, self).update()
         self.consumers = self.getConsumers()
+        self.token_counts = self.getTokenCounts(self.consumers)
         self.request['disable_border'] = True
 
     @button.buttonAndHandler(_('Remove'), name='remove')
@@ -86,9 +111,8 @@ class ConsumerManageForm(form.PostForm):
         # manually do everything since we are not using the built-in
         # widgets
         # TODO build/use widgets?
-        # removing consumers does not remove corresponding tokens that 
-        # were issued previous to this, although the tokens will cease
-        # to work without the corresponding secret.
+        # the tokens issued to the removed consumers are revoked along
+        # with them, as they would otherwise linger in the token manager.
         data, errors = self.extractData()
 
         removed = error = 0
@@ -99,12 +123,18 @@ class ConsumerManageForm(form.PostForm):
         
         cm = zope.component.getMultiAdapter((self.context, self.request),
             IConsumerManager)
+        sm = zope.component.getMultiAdapter((self.context, self.request),
+            IScopeManager)
         for k in keys:
             try:
                 cm.remove(k)
-                removed += 1
-            except:
+            except KeyError:
                 error = 1
+                continue
+            revokeTokens(self.context, self.request, consumer_key=k,
+                commit=False)
+            sm.delClientScope(k, None)
+            removed += 1
 
         status = IStatusMessage(self.request)
         if error:
@@ -1,12 +1,26 @@
+import binascii
+from hashlib import sha1
+
 import zope.component
 
 from zope.component.hooks import getSite
 from oauthlib.oauth1.rfc5849.endpoints import base
 from oauthlib.oauth1.rfc5849.errors import OAuth1Error
+from oauthlib.common import safe_string_equals
 from oauthlib.oauth1 import ResourceEndpoint
+from oauthlib.oauth1 import SIGNATURE_RSA, SIGNATURE_HMAC
+from oauthlib.oauth1.rfc5849 import signature
 
 from pmr2.oauth.interfaces import IOAuthRequestValidatorAdapter
+from pmr2.oauth.cache import getRequestManager, LRUCache
 from pmr2.oauth.utility import safe_unicode, extractRequestURL
+from pmr2.oauth.utility import extractRequestBody, hmacContext
+
+# The results of the signature verifications done by this process, so
+# that the same request being validated again (by the further passes of
+# the extraction by PAS, or after the request is retried on a conflict)
+# will not have its signature computed again.
+signature_verdicts = LRUCache(maxsize=10000, ttl=60)
 
 
 class BaseEndpoint(base.BaseEndpoint):
@@ -18,7 +32,7 @@ class BaseEndpoint(base.BaseEndpoint):
     @property
     def request_validator(self):
         site = getSite()
-        return zope.component.getMultiAdapter((site, self.request),
+        return getRequestManager(site, self.request,
             IOAuthRequestValidatorAdapter)
 
     @property
@@ -44,12 +58,85 @@ class BaseEndpoint(base.BaseEndpoint):
                 headers[u'Authorization'] = safe_unicode(self.request._auth)
 
         if body is None:
-            self.request.stdin.seek(0)
-            body = safe_unicode(self.request.stdin.read())
+            body = extractRequestBody(self.request)
 
         return base.BaseEndpoint._create_request(self,
             uri, http_method, body, headers)
 
+    def _secrets(self, request, is_token_request):
+        validator = self.request_validator
+        client_secret = validator.get_client_secret(
+            request.client_key, request)
+        resource_owner_secret = None
+        if request.resource_owner_key:
+            if is_token_request:
+                resource_owner_secret = validator.get_request_token_secret(
+                    request.client_key, request.resource_owner_key, request)
+            else:
+                resource_owner_secret = validator.get_access_token_secret(
+                    request.client_key, request.resource_owner_key, request)
+        return client_secret, resource_owner_secret
+
+    def _signatureKey(self, request, is_token_request, client_secret,
+            resource_owner_secret):
+        """
+        The key for the verdict, which includes a digest of everything
+        that goes into the signature such that the verdict will not be
+        reused for a request that differs in any way.
+        """
+
+        raw = u'\0'.join([safe_unicode(v or u'') for v in (
+            request.http_method,
+            request.uri,
+            request.body,
+            request.headers.get(u'Authorization'),
+            request.headers.get(u'Content-Type'),
+            client_secret,
+            resource_owner_secret,
+        )])
+
+        return (request.client_key, request.resource_owner_key,
+            request.nonce, request.timestamp, request.signature,
+            is_token_request, sha1(raw.encode('utf-8')).hexdigest())
+
+    def _check_signature(self, request, is_token_request=False):
+        if request.signature_method == SIGNATURE_RSA:
+            # Consumers without a usable key cannot be verified at all.
+            if self.request_validator.get_rsa_key(
+                    request.client_key, request) is None:
+                return False
+            return base.BaseEndpoint._check_signature(self, request,
+                is_token_request)
+
+        # The secrets are looked up once for both the key and the check.
+        secrets = self._secrets(request, is_token_request)
+        key = self._signatureKey(request, is_token_request, *secrets)
+        verdict = signature_verdicts.get(key)
+        if verdict is None:
+            if request.signature_method == SIGNATURE_HMAC:
+                verdict = self._verifyHMAC(request, *secrets)
+            else:
+                verdict = signature.verify_plaintext(request, *secrets)
+            signature_verdicts.set(key, verdict)
+        return verdict
+
+    def _verifyHMAC(self, request, client_secret, resource_owner_secret):
+        """
+        Same as signature.verify_hmac_sha1, but with the HMAC context
+        prepared for the consumer and token pair.
+        """
+
+        norm_params = signature.normalize_parameters(request.params)
+        uri = signature.normalize_base_string_uri(request.uri)
+        base_string = signature.construct_base_string(request.http_method,
+            uri, norm_params)
+
+        context = hmacContext(request.client_key, request.resource_owner_key,
+            client_secret, resource_owner_secret)
+        context.update(base_string.encode('utf-8'))
+        result = binascii.b2a_base64(context.digest())[:-1].decode('utf-8')
+        return safe_string_equals(result, request.signature)
+
 
 class ResourceEndpointValidator(BaseEndpoint, ResourceEndpoint):
     """
@@ -1,5 +1,10 @@
+import json
+
 import zope.component
 import zope.interface
+from zope.publisher.browser import BrowserPage
+
+from zExceptions import BadRequest
 
 from Products.CMFCore.utils import getToolByName
 
@@ -7,6 +12,8 @@ from pmr2.z3cform import page
 
 from pmr2.oauth import MessageFactory as _
 from pmr2.oauth.browser.template import path, ViewPageTemplateFile
+from pmr2.oauth import instrument
+from pmr2.oauth.maintenance import purgeExpiredTokens
 
 
 class PMR2OAuthPage(page.SimplePage):
@@ -28,3 +35,43 @@ class PMR2OAuthPage(page.SimplePage):
 
     def update(self):
         self.request['disable_border'] = True
+
+
+class PurgeExpiredTokensPage(BrowserPage):
+    """
+    Purge the expired request tokens, intended to be called by the
+    clock server or a cron job to sweep away the abandoned ones.
+    """
+
+    default_batch_size = 100
+
+    def __call__(self):
+        try:
+            batch_size = int(self.request.form.get('batch_size',
+                self.default_batch_size))
+            max_batches = self.request.form.get('max_batches', None)
+            if max_batches is not None:
+                max_batches = int(max_batches)
+        except ValueError:
+            raise BadRequest('batch_size and max_batches must be integers')
+        if batch_size < 1 or (max_batches is not None and max_batches < 0):
+            raise BadRequest('batch_size must be at least 1 and '
+                'max_batches must not be negative')
+
+        total = purgeExpiredTokens(self.context, self.request,
+            batch_size=batch_size, max_batches=max_batches)
+        self.request.response.setHeader('Content-type', 'text/plain')
+        return 'Purged %d expired request tokens.' % total
+
+
+class InstrumentationPage(BrowserPage):
+    """
+    The timings of the stages of the OAuth authentication recorded by
+    this process as JSON.  POST with ``reset`` to clear them.
+    """
+
+    def __call__(self):
+        if self.request.method == 'POST' and 'reset' in self.request.form:
+            instrument.stats.reset()
+        self.request.response.setHeader('Content-type', 'application/json')
+        return json.dumps(instrument.stats.snapshot(), sort_keys=True)
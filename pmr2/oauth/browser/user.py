@@ -1,3 +1,5 @@
+from urllib import urlencode
+
 import zope.component
 import zope.interface
 from zope.publisher.browser import BrowserPage
@@ -32,6 +34,9 @@ class BaseUserTokenForm(form.PostForm):
     ignoreContext = True
     template = ViewPageTemplateFile(path('user_manage_token.pt'))
 
+    # number of tokens listed on each page.
+    batch_size = 50
+
     @property
     def url_expr(self):
         # URL expression for this view.
@@ -41,18 +46,34 @@ class BaseUserTokenForm(form.PostForm):
         # Returns the current user, or the target user.
         raise NotImplemented
 
+    @property
+    def next_url(self):
+        if self.next_start is None:
+            return None
+        return '%s?%s' % (self.url_expr, urlencode({'start': self.next_start}))
+
     def getTokens(self):
         user = self.getUser()
         cm = zope.component.getMultiAdapter((self.context, self.request),
             IConsumerManager)
         tm = zope.component.getMultiAdapter((self.context, self.request),
             ITokenManager)
+
+        # Only the summaries kept by the user index are needed, and the
+        # consumers are looked up once for each distinct one.
+        self.start = self.request.form.get('start') or None
+        summaries, self.next_start = tm.getTokenPageForUser(user,
+            self.start, self.batch_size)
+        titles = {}
         tokens = []
-        for token in tm.getTokensForUser(user):
-            consumer_title = cm.get(token.consumer_key, _NotConsumer).title
+        for summary in summaries:
+            consumer_key = summary['consumer_key']
+            if consumer_key not in titles:
+                titles[consumer_key] = cm.get(consumer_key, _NotConsumer).title
             tokens.append({
-                'consumer_title': consumer_title,
-                'key': token.key,
+                'consumer_title': titles[consumer_key],
+                'key': summary['key'],
+                'timestamp': summary['timestamp'],
             })
         return tokens
 
@@ -71,7 +92,6 @@ class BaseUserTokenForm(form.PostForm):
         # TODO use widgets?
 
         current_user = self.getUser()
-        valid = self.getTokens()
         removed = error = 0
         keys = self.request.form.get('form.widgets.key', [])
         if isinstance(keys, basestring):
@@ -83,18 +103,19 @@ class BaseUserTokenForm(form.PostForm):
         sm = zope.component.getMultiAdapter((self.context, self.request),
             IScopeManager)
 
+        owned = []
         for k in keys:
             token = tm.get(k)
             if token is None or not token.user == current_user:
                 error = 1
                 continue
+            owned.append(k)
 
-            try:
-                tm.remove(k)
-                sm.delAccessScope(k, None)
-                removed += 1
-            except:
-                error = 1
+        revoked = tm.removeTokens(owned)
+        sm.purgeScopes(revoked)
+        removed = len(revoked)
+        if removed < len(owned):
+            error = 1
 
         status = IStatusMessage(self.request)
         if error:
@@ -0,0 +1,262 @@
+import time
+import threading
+
+import zope.component
+from zope.component.interfaces import ComponentLookupError
+from zope.annotation.interfaces import IAnnotations
+
+from Acquisition import aq_base
+
+request_cache_key = 'pmr2.oauth.cache'
+
+_marker = object()
+
+
+def getRequestCache(request):
+    """\
+    Return the dict that lives for the duration of the request, stored
+    within its annotations.
+
+    If the request cannot be annotated a new empty dict is returned,
+    which means nothing gets memoized.
+    """
+
+    if request is None:
+        return {}
+
+    annotations = IAnnotations(request, None)
+    if annotations is None:
+        return {}
+
+    cache = annotations.get(request_cache_key, None)
+    if cache is None:
+        cache = {}
+        annotations[request_cache_key] = cache
+    return cache
+
+
+def queryRequestManager(site, request, iface, default=None):
+    """\
+    Look up the multi-adapter providing iface for (site, request), once
+    per request.
+    """
+
+    cache = getRequestCache(request)
+    key = ('manager', iface)
+    base = aq_base(site)
+    entry = cache.get(key, None)
+    if entry is None or entry[0] is not base:
+        manager = zope.component.queryMultiAdapter((site, request), iface)
+        entry = (base, manager)
+        cache[key] = entry
+
+    manager = entry[1]
+    if manager is None:
+        return default
+    return manager
+
+
+def getRequestManager(site, request, iface):
+    """\
+    Same as above, but raises ComponentLookupError if not found.
+    """
+
+    manager = queryRequestManager(site, request, iface, _marker)
+    if manager is _marker:
+        raise ComponentLookupError((site, request), iface, u'')
+    return manager
+
+
+def memoize(request, key, func, *a, **kw):
+    """\
+    Return the result of func(*a, **kw) stored under key in the request
+    cache, calling it only if there is no such result.  Exceptions are
+    not memoized.
+    """
+
+    cache = getRequestCache(request)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    result = func(*a, **kw)
+    cache[key] = result
+    return result
+
+
+def invalidate(request, key):
+    """\
+    Remove the memoized result for key.
+    """
+
+    getRequestCache(request).pop(key, None)
+
+
+class LRUCache(object):
+    """\
+    A bounded, thread-safe mapping for use as a process wide cache.
+
+    Once maxsize entries are stored, the least recently used ones are
+    discarded.  Entries may also be given a time to live (in seconds),
+    either by default through ttl or on a per entry basis, after which
+    they are treated as absent.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._lock = threading.Lock()
+        # key to links, each being [prev, next, key, value, expiry], in
+        # a circular list where root.next is the least recently used.
+        self._data = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = link
+        root[0] = link
+
+    def _expiry(self, ttl):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None:
+            return None
+        return self._timer() + ttl
+
+    def _expired(self, link):
+        return link[4] is not None and link[4] <= self._timer()
+
+    def _lookup(self, key):
+        # must be called with the lock held.
+        link = self._data.get(key, None)
+        if link is None:
+            return None
+        if self._expired(link):
+            self._discard(link)
+            return None
+        return link
+
+    def _discard(self, link):
+        # must be called with the lock held.
+        self._unlink(link)
+        del self._data[link[2]]
+
+    def _makeRoom(self):
+        # must be called with the lock held.
+        while len(self._data) >= self.maxsize:
+            self._discard(self._root[1])
+        return True
+
+    def _store(self, key, value, ttl):
+        # must be called with the lock held.
+        link = self._data.get(key, None)
+        if link is not None:
+            self._unlink(link)
+        elif not self._makeRoom():
+            return False
+        link = [None, None, key, value, self._expiry(ttl)]
+        self._data[key] = link
+        self._append(link)
+        return True
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._lookup(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        self._lock.acquire()
+        try:
+            return self._store(key, value, ttl)
+        finally:
+            self._lock.release()
+
+    def add(self, key, value, ttl=None):
+        """\
+        Store value only if there is no such key.  Returns True if the
+        value was stored.
+        """
+
+        self._lock.acquire()
+        try:
+            if self._lookup(key) is not None:
+                return False
+            return self._store(key, value, ttl)
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._lookup(key)
+            if link is None:
+                return default
+            self._discard(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def keys(self):
+        self._lock.acquire()
+        try:
+            return self._data.keys()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            root = self._root
+            root[:] = [root, root, None, None, None]
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        self._lock.acquire()
+        try:
+            return self._lookup(key) is not None
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ExpiringCache(LRUCache):
+    """    A bounded cache that never discards an entry before it expires.
+
+    Once maxsize entries are stored, only the expired ones are discarded
+    to make room, starting from the least recently used, and new keys
+    are refused (set and add return False) while the cache is full of
+    live entries.  Meant for entries that must be remembered for their
+    whole time to live, such as the nonces.
+    """
+
+    def _makeRoom(self):
+        # must be called with the lock held.  Stops at the first live
+        # entry rather than scanning the whole cache, so an expired one
+        # behind it will only be discarded later.
+        while len(self._data) >= self.maxsize:
+            oldest = self._root[1]
+            if not self._expired(oldest):
+                return False
+            self._discard(oldest)
+        return True
@@ -9,7 +9,8 @@ from zope.schema import fieldproperty
 from pmr2.oauth.interfaces import IConsumer
 from pmr2.oauth.interfaces import IConsumerManager
 from pmr2.oauth.factory import factory
-from pmr2.oauth.utility import random_string
+from pmr2.oauth.utility import random_string, forgetUnknownKey
+from pmr2.oauth.utility import forgetHMACContext
 
 
 class ConsumerManager(Persistent, Contained):
@@ -45,6 +46,7 @@ class ConsumerManager(Persistent, Contained):
         if self.get(consumer.key):
             raise ValueError('consumer %s already exists', consumer.key)
         self._consumers[consumer.key] = consumer
+        forgetUnknownKey('consumer', consumer.key)
 
     def get(self, consumer_key, default=None):
         return self._consumers.get(consumer_key, default)
@@ -56,6 +58,20 @@ class ConsumerManager(Persistent, Contained):
     def getAllKeys(self):
         return self._consumers.keys()
 
+    def getConsumerPage(self, start=None, batch_size=50):
+        if start is None:
+            items = self._consumers.values()
+        else:
+            items = self._consumers.values(min=start, excludemin=True)
+
+        consumers = []
+        for consumer in items:
+            if len(consumers) == batch_size:
+                # more remain, continue after the last one returned.
+                return consumers, consumers[-1].key
+            consumers.append(consumer)
+        return consumers, None
+
     def makeDummy(self):
         return Consumer(str(self.DUMMY_KEY), str(self.DUMMY_SECRET))
 
@@ -63,6 +79,7 @@ class ConsumerManager(Persistent, Contained):
         if IConsumer.providedBy(consumer):
             consumer = consumer.key
         self._consumers.pop(consumer)
+        forgetHMACContext(consumer)
 
 ConsumerManagerFactory = factory(ConsumerManager)
 
@@ -78,13 +95,15 @@ class Consumer(Persistent):
     secret = fieldproperty.FieldProperty(IConsumer['secret'])
     title = fieldproperty.FieldProperty(IConsumer['title'])
     domain = fieldproperty.FieldProperty(IConsumer['domain'])
+    rsa_key = fieldproperty.FieldProperty(IConsumer['rsa_key'])
 
-    def __init__(self, key, secret, title=None, domain=None):
+    def __init__(self, key, secret, title=None, domain=None, rsa_key=None):
         assert not ((key is None) or (secret is None))
         self.key = key
         self.secret = secret
         self.title = title
         self.domain = domain
+        self.rsa_key = rsa_key
 
     def __eq__(self, other):
         same_type = isinstance(other, self.__class__)
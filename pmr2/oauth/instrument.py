@@ -0,0 +1,192 @@
+"""\
+Opt-in timing of the stages of the OAuth authentication.
+
+Disabled by default, at which point the hooks return immediately.  It
+can be enabled for the process by setting the ``PMR2_OAUTH_INSTRUMENT``
+environment variable (optionally to the number of authentications
+between each summary written to the log), or by calling ``enable``.
+
+The hooks are used like so::
+
+    start = instrument.start()
+    ...
+    start = instrument.record('stage', start)
+    ...
+    instrument.record('next_stage', start)
+"""
+
+import os
+import time
+import threading
+from logging import getLogger
+
+logger = getLogger('pmr2.oauth.instrument')
+
+timer = time.time
+
+# Upper bounds (in milliseconds) of the buckets of the histograms.
+buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Stats(object):
+    """\
+    Per stage timing histograms and counters.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.timings = {}
+            self.counters = {}
+        finally:
+            self._lock.release()
+
+    def record(self, stage, elapsed):
+        ms = elapsed * 1000
+        self._lock.acquire()
+        try:
+            timing = self.timings.get(stage)
+            if timing is None:
+                timing = self.timings[stage] = {
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'histogram': [0] * (len(buckets) + 1),
+                }
+            timing['count'] += 1
+            timing['total_ms'] += ms
+            timing['max_ms'] = max(timing['max_ms'], ms)
+            i = 0
+            for bound in buckets:
+                if ms <= bound:
+                    break
+                i += 1
+            timing['histogram'][i] += 1
+            return timing['count']
+        finally:
+            self._lock.release()
+
+    def count(self, name, value=1):
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """\
+        Return a copy of the statistics, with the histograms keyed by
+        the upper bound of each bucket.
+        """
+
+        self._lock.acquire()
+        try:
+            timings = {}
+            for stage, timing in self.timings.items():
+                histogram = dict(zip(
+                    [str(b) for b in buckets] + ['inf'],
+                    timing['histogram']))
+                timings[stage] = {
+                    'count': timing['count'],
+                    'total_ms': timing['total_ms'],
+                    'mean_ms': timing['total_ms'] / timing['count'],
+                    'max_ms': timing['max_ms'],
+                    'histogram': histogram,
+                }
+            return {
+                'enabled': enabled(),
+                'timings': timings,
+                'counters': dict(self.counters),
+            }
+        finally:
+            self._lock.release()
+
+
+stats = Stats()
+
+# the state, as [enabled, log_interval].
+_state = [False, None]
+
+
+def enable(log_interval=None):
+    """\
+    Start recording, logging the summary every log_interval
+    authentications if specified.
+    """
+
+    _state[:] = [True, log_interval]
+
+
+def disable():
+    _state[:] = [False, None]
+
+
+def enabled():
+    return _state[0]
+
+
+def start():
+    """\
+    Return the current time if enabled, otherwise None.
+    """
+
+    if _state[0]:
+        return timer()
+
+
+def record(stage, started):
+    """\
+    Record the time taken by the stage since started, and return the
+    current time as the start of the next stage.
+    """
+
+    if started is None:
+        return None
+    now = timer()
+    stats.record(stage, now - started)
+    return now
+
+
+def count(name, value=1):
+    if _state[0]:
+        stats.count(name, value)
+
+
+def finish(started):
+    """\
+    Record the time taken by the whole authentication since started,
+    logging the summary at the configured interval.
+    """
+
+    if started is None:
+        return
+    total = stats.record('total', timer() - started)
+    log_interval = _state[1]
+    if log_interval and not total % log_interval:
+        logStats()
+
+
+def logStats():
+    snapshot = stats.snapshot()
+    for stage, timing in sorted(snapshot['timings'].items()):
+        logger.info('%s: count=%d mean=%.3fms max=%.3fms', stage,
+            timing['count'], timing['mean_ms'], timing['max_ms'])
+    for name, value in sorted(snapshot['counters'].items()):
+        logger.info('%s: %d', name, value)
+
+
+def _enableFromEnviron(value):
+    if not value:
+        return
+    try:
+        log_interval = int(value)
+    except ValueError:
+        log_interval = None
+    # 1 would be the flag rather than an interval.
+    enable(log_interval > 1 and log_interval or None)
+
+_enableFromEnviron(os.environ.get('PMR2_OAUTH_INSTRUMENT'))
@@ -55,6 +55,18 @@ class InvalidScopeError(BaseValueError):
     __doc__ = "invalid scope."
 
 
+class RSAKeyValueError(zope.schema.ValidationError):
+    __doc__ = _(u'The RSA public key could not be parsed.')
+
+
+def validRSAKey(value):
+    # imported here as the utility module depends on this one.
+    from pmr2.oauth.utility import checkRSAKey
+    if not checkRSAKey(value):
+        raise RSAKeyValueError(value)
+    return True
+
+
 class IOAuthRequestValidatorAdapter(zope.interface.Interface):
     """
     Interface for the OAuth adapter.
@@ -114,6 +126,14 @@ class IConsumer(zope.interface.Interface):
         required=False,
     )
 
+    rsa_key = zope.schema.Text(
+        title=_(u'RSA Public Key'),
+        description=_(u'The PEM encoded RSA public key of this client, only '
+                      'required if it signs its requests using RSA-SHA1.'),
+        required=False,
+        constraint=validRSAKey,
+    )
+
     def validate():
         """
         Self validation.
@@ -145,6 +165,13 @@ class IConsumerManager(zope.interface.Interface):
         Return all client keys tracked by this client manager.
         """
 
+    def getConsumerPage(start=None, batch_size=50):
+        """\
+        Return a tuple of the list of up to batch_size clients with keys
+        following start (or from the first one if not specified) in key
+        order, and the start for the next page (None for the last one).
+        """
+
     def getValidated(consumer_key, default=None):
         """\
         Return a client only if it is a validated one.
@@ -212,6 +239,12 @@ class IScopeManager(zope.interface.Interface):
         Delete the scope for the provided access_key.
         """
 
+    def purgeScopes(keys):
+        """
+        Delete both the pending scopes and the access scopes for the
+        provided token keys, skipping the missing ones.
+        """
+
     def requestScope(request_key, rawscope):
         """
         Request a scope for the temporary credentials identified by the
@@ -471,11 +504,105 @@ class ITokenManager(zope.interface.Interface):
         Return a list of token keys for a user.
         """
 
+    def getTokenPageForUser(user, start=None, batch_size=50):
+        """\
+        Return a tuple of the list of summaries of up to batch_size
+        access tokens of the user with keys following start, and the
+        start for the next page (None for the last one).
+
+        The summaries are dicts with the key, consumer_key and timestamp
+        of the token, which are available without loading the tokens.
+        """
+
+    def getTokensForConsumer(consumer_key):
+        """\
+        Return the list of access tokens issued to the consumer.
+        """
+
+    def countTokensForConsumer(consumer_key):
+        """\
+        Return the number of access tokens issued to the consumer,
+        without loading the tokens.
+        """
+
     def remove(token):
         """\
         Remove token.
         """
 
+    def purgeExpiredTokens(timestamp=None, limit=None):
+        """\
+        Remove request tokens that have expired by timestamp (defaults
+        to now), up to limit number of tokens if specified.
+
+        Returns the list of keys of the removed tokens.
+        """
+
+    def removeTokens(keys):
+        """\
+        Remove the tokens identified by keys, skipping the missing ones.
+
+        Returns the list of keys of the removed tokens.
+        """
+
+    def revokeTokensForConsumer(consumer_key, limit=None):
+        """\
+        Remove the access tokens issued to the consumer, up to limit
+        number of tokens if specified.
+
+        Returns the list of keys of the removed tokens.
+        """
+
+    def revokeTokensForUser(user, limit=None):
+        """\
+        Remove the access tokens of the user, up to limit number of
+        tokens if specified.
+
+        Returns the list of keys of the removed tokens.
+        """
+
+    def revokeTokensBefore(timestamp, limit=None):
+        """\
+        Remove the access tokens created before timestamp, up to limit
+        number of tokens if specified.
+
+        Returns the list of keys of the removed tokens.
+        """
+
+    def compactTokens(start=None, limit=None):
+        """\
+        Convert up to limit number of the stored tokens with keys
+        following start into compact records, with the tokens added
+        from then on stored as records also.
+
+        Returns the key to start the next batch from, or None if done.
+        """
+
+    def recordUsage(token_key, timestamp=None):
+        """\
+        Record the use of the access token at timestamp (defaults to
+        now).  The record may be buffered and written out later.
+        """
+
+    def getLastUsed(token_key):
+        """\
+        Return the time the access token was last used, or None.
+        """
+
+    def getIdleTokens(timestamp, limit=None):
+        """\
+        Return the keys of the access tokens neither created nor used
+        since timestamp, up to limit number of keys if specified.
+        """
+
+    def revokeIdleTokens(timestamp, limit=None):
+        """\
+        Remove the access tokens neither created nor used since
+        timestamp, up to limit number of tokens if specified.
+
+        Returns the list of keys of the removed tokens.
+        """
+
 
 # Other management interfaces
 
@@ -507,11 +634,59 @@ class INonceManager(zope.interface.Interface):
     If nonce must be checked specifically, implement this manager.
     """
 
-    def check(timestamp, nonce):
+    def check(client_key, timestamp, nonce, token=None, request=None):
+        """\
+        Check that this nonce can be used, i.e. the timestamp is recent
+        enough and the nonce has not been used before with the same
+        client key, timestamp and token.  The nonce will be recorded as
+        used.
+
+        Return True if it can be used, False otherwise.
+        """
+
+
+class IMemoryNonceManagerLayer(zope.interface.Interface):
+    """\
+    Layer that selects the nonce manager which keeps the nonces in the
+    memory of the current process instead of the ZODB.
+    """
+
+
+class IKeyValueStore(zope.interface.Interface):
+    """\
+    An external key-value store for short lived values, such as nonces
+    and request tokens.  Keys are ASCII strings without whitespace, the
+    values are strings; ttl is in seconds, with 0 meaning no expiry.
+    """
+
+    def add(key, value, ttl=0):
+        """\
+        Store value only if key is not present, atomically.  Returns
+        True if stored.
+        """
+
+    def set(key, value, ttl=0):
         """\
-        Check that this nonce can be used.
+        Store value.
         """
 
+    def get(key, default=None):
+        """\
+        Return the value stored for key, or default.
+        """
+
+    def delete(key):
+        """\
+        Remove the key.  Returns True if it was present.
+        """
+
+
+class IKeyValueStoreLayer(zope.interface.Interface):
+    """\
+    Layer that selects the nonce and token managers which keep the short
+    lived values in the IKeyValueStore utility.
+    """
+
 
 class _IDynamicSchemaInterface(zope.interface.Interface):
     """
@@ -0,0 +1,134 @@
+from logging import getLogger
+
+import transaction
+import zope.component
+
+from pmr2.oauth.interfaces import ITokenManager, IScopeManager
+
+logger = getLogger('pmr2.oauth')
+
+
+def _checkBatches(batch_size, max_batches):
+    # otherwise the batches would never run out.
+    if batch_size < 1:
+        raise ValueError('batch_size must be at least 1')
+    if max_batches is not None and max_batches < 0:
+        raise ValueError('max_batches must not be negative')
+
+
+def purgeExpiredTokens(site, request, batch_size=100, max_batches=None,
+        commit=True):
+    """
+    Purge the expired request tokens along with their pending scopes.
+
+    The tokens are removed in batches of batch_size, with the work done
+    by each batch committed as its own transaction if commit is True,
+    such that a large backlog of abandoned tokens will not result in a
+    single massive transaction.  Stops after max_batches if specified.
+
+    Returns the total number of tokens purged.
+    """
+
+    _checkBatches(batch_size, max_batches)
+    tm = zope.component.getMultiAdapter((site, request), ITokenManager)
+    sm = zope.component.queryMultiAdapter((site, request), IScopeManager)
+
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        keys = tm.purgeExpiredTokens(limit=batch_size)
+        if sm is not None:
+            for key in keys:
+                sm.popScope(key, None)
+
+        total += len(keys)
+        batches += 1
+
+        if commit and keys:
+            transaction.commit()
+
+        if len(keys) < batch_size:
+            break
+
+    logger.info('Purged %d expired request tokens.', total)
+    return total
+
+
+def revokeTokens(site, request, consumer_key=None, user=None, before=None,
+        idle_before=None, batch_size=100, max_batches=None, commit=True):
+    """
+    Revoke the tokens issued to the consumer, or the access tokens of
+    the user, or the access tokens created before the timestamp, or the
+    access tokens neither created nor used since idle_before (only one
+    of these can be specified), along with their scopes.
+
+    The work is done in batches like purgeExpiredTokens above, and the
+    total number of tokens revoked is returned.
+    """
+
+    criteria = [c for c in (consumer_key, user, before, idle_before)
+        if c is not None]
+    if len(criteria) != 1:
+        raise ValueError('exactly one of consumer_key, user, before or '
+            'idle_before must be specified')
+    _checkBatches(batch_size, max_batches)
+
+    tm = zope.component.getMultiAdapter((site, request), ITokenManager)
+    sm = zope.component.queryMultiAdapter((site, request), IScopeManager)
+
+    if consumer_key is not None:
+        revoke = lambda: tm.revokeTokensForConsumer(consumer_key, batch_size)
+    elif user is not None:
+        revoke = lambda: tm.revokeTokensForUser(user, batch_size)
+    elif before is not None:
+        revoke = lambda: tm.revokeTokensBefore(before, batch_size)
+    else:
+        revoke = lambda: tm.revokeIdleTokens(idle_before, batch_size)
+
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        keys = revoke()
+        if sm is not None:
+            sm.purgeScopes(keys)
+
+        total += len(keys)
+        batches += 1
+
+        if commit and keys:
+            transaction.commit()
+
+        if len(keys) < batch_size:
+            break
+
+    logger.info('Revoked %d tokens.', total)
+    return total
+
+
+def compactTokens(site, request, start=None, batch_size=1000,
+        max_batches=None, commit=True):
+    """
+    Convert the tokens of the token manager into compact records, in
+    batches of batch_size like purgeExpiredTokens above, starting after
+    the key start if specified.
+
+    Returns the key to resume from if stopped by max_batches, otherwise
+    None.
+    """
+
+    _checkBatches(batch_size, max_batches)
+    tm = zope.component.getMultiAdapter((site, request), ITokenManager)
+
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        start = tm.compactTokens(start, batch_size)
+        batches += 1
+
+        if commit:
+            transaction.commit()
+
+        if start is None:
+            break
+
+    logger.info('Compacted the tokens in %d batches.', batches)
+    return start
@@ -0,0 +1,287 @@
+import time
+from logging import getLogger
+
+import transaction
+
+from persistent import Persistent
+from BTrees.OOBTree import OOTreeSet
+from BTrees.IOBTree import IOBTree
+
+from zope.container.contained import Contained
+from zope.annotation.interfaces import IAttributeAnnotatable
+import zope.component
+import zope.interface
+
+from pmr2.oauth.interfaces import INonceManager
+from pmr2.oauth.interfaces import IMemoryNonceManagerLayer
+from pmr2.oauth.interfaces import IKeyValueStore, IKeyValueStoreLayer
+from pmr2.oauth.factory import factory
+from pmr2.oauth.cache import ExpiringCache
+from pmr2.oauth.backend import storeKey
+from pmr2.oauth.shard import shardOf
+
+try:
+    from plone.protect.auto import safeWrite
+except ImportError:  # pragma: no cover
+    def safeWrite(obj, request=None):
+        pass
+
+
+logger = getLogger('pmr2.oauth')
+
+
+def checkTimestamp(timestamp, window, now):
+    """\
+    Return the timestamp as an int if it is within window seconds of
+    now, otherwise None.
+    """
+
+    try:
+        timestamp = int(timestamp)
+    except (TypeError, ValueError):
+        return None
+
+    if abs(now - timestamp) > window:
+        return None
+    return timestamp
+
+
+class NonceManager(Persistent, Contained):
+    """\
+    Nonce manager that keeps the nonces in buckets keyed by the time
+    slice their timestamps fall within.
+
+    Only the nonces with timestamps within the window around the current
+    time are accepted, so once a bucket falls out of the window it can
+    be dropped as a whole, without looking at the nonces inside it.
+
+    Note that every signed request, including the GETs, writes its nonce
+    into the ZODB.  The nonces of each time slice are spread over a
+    number of sets by the hash of the nonce so that concurrent requests
+    seldom write to the same one, but where the write and conflict cost
+    matters the memory or the key value store nonce managers should be
+    used instead.
+    """
+
+    zope.component.adapts(IAttributeAnnotatable, zope.interface.Interface)
+    zope.interface.implements(INonceManager)
+
+    # Nonces with timestamps differing from current time by more than
+    # this many seconds are rejected; same as the default lifetime of
+    # the timestamps accepted by oauthlib.
+    window = 600
+
+    # Size (in seconds) of the time slice for each bucket.
+    bucket_size = 60
+
+    # Number of sets the nonces of each time slice are spread over.
+    shard_count = 16
+
+    def __init__(self):
+        # the time slice times shard_count plus the shard to the set of
+        # nonces, such that the sets of a time slice are adjacent.
+        self._buckets = IOBTree()
+
+    def _bucket(self, timestamp, nonce=None):
+        bucket = timestamp // self.bucket_size * self.shard_count
+        if nonce is None:
+            return bucket
+        return bucket + shardOf(nonce, self.shard_count)
+
+    def purge(self, timestamp=None):
+        """\
+        Drop the buckets that have fallen out of the window.
+        """
+
+        if timestamp is None:
+            timestamp = int(time.time())
+
+        oldest = self._bucket(timestamp - self.window)
+        expired = list(self._buckets.keys(max=oldest, excludemax=True))
+        for key in expired:
+            del self._buckets[key]
+        return len(expired)
+
+    def check(self, client_key, timestamp, nonce, token=None, request=None):
+        now = int(time.time())
+        timestamp = checkTimestamp(timestamp, self.window, now)
+        if timestamp is None:
+            return False
+
+        self.purge(now)
+
+        bucket = self._bucket(timestamp, nonce)
+        nonces = self._buckets.get(bucket, None)
+        if nonces is None:
+            nonces = OOTreeSet()
+            self._buckets[bucket] = nonces
+
+        # Writing on every request, including the GETs.
+        safeWrite(self, request)
+        safeWrite(self._buckets, request)
+        safeWrite(nonces, request)
+
+        key = (client_key, timestamp, nonce, token or u'')
+        # insert returns a false value if the key was present.
+        return bool(nonces.insert(key))
+
+NonceManagerFactory = factory(NonceManager)
+
+
+class NonceRelease(object):
+    """\
+    Data manager joined to the transaction of the request that checked
+    a nonce, calling release (with a false status, like an after commit
+    hook of a failed commit) when the transaction is aborted or fails
+    to commit, as the request may be retried with the very same nonce
+    (e.g. by the publisher on ConflictError).
+
+    Nothing is written by this, so it takes part in the two phase
+    commit without doing anything.
+    """
+
+    def __init__(self, release, *args):
+        self.release = release
+        self.args = args
+        self.transaction_manager = transaction.manager
+
+    def _release(self):
+        self.release(False, *self.args)
+
+    def abort(self, txn):
+        self._release()
+
+    def tpc_abort(self, txn):
+        self._release()
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        pass
+
+    def sortKey(self):
+        return 'pmr2.oauth.nonce:%d' % id(self)
+
+    def savepoint(self):
+        # the nonce stays consumed when rolled back to a savepoint.
+        return NonceReleaseSavepoint()
+
+
+class NonceReleaseSavepoint(object):
+
+    def rollback(self):
+        pass
+
+
+# The nonces seen by this process, each kept until its timestamp falls
+# out of the window.
+memory_nonces = ExpiringCache(maxsize=100000)
+
+
+class MemoryNonceManager(object):
+    """\
+    Nonce manager that keeps the recently seen nonces within the memory
+    of the current process, rather than writing them into the ZODB.
+
+    Note that the nonces are not shared across processes (e.g. between
+    ZEO clients), and that while the cache is full of nonces with their
+    timestamps still within the window new nonces are rejected, as
+    discarding any of them would allow it to be replayed.
+    """
+
+    zope.component.adapts(IAttributeAnnotatable, IMemoryNonceManagerLayer)
+    zope.interface.implements(INonceManager)
+
+    # See NonceManager.
+    window = 600
+
+    def __init__(self, context, request):
+        self.context = context
+        self.request = request
+        # As the nonces of every site in this process are stored in the
+        # same cache.
+        getPhysicalPath = getattr(context, 'getPhysicalPath', None)
+        if getPhysicalPath is None:
+            self.prefix = None
+        else:
+            self.prefix = '/'.join(getPhysicalPath())
+
+    def check(self, client_key, timestamp, nonce, token=None, request=None):
+        now = int(time.time())
+        timestamp = checkTimestamp(timestamp, self.window, now)
+        if timestamp is None:
+            return False
+
+        # Only need to be remembered until the timestamp falls out of
+        # the window, as it will be rejected from then on.
+        ttl = timestamp + self.window - now + 1
+        key = (self.prefix, client_key, nonce)
+        if not memory_nonces.add(key, timestamp, ttl):
+            if key not in memory_nonces:
+                logger.warning('The memory nonce cache is full, rejecting '
+                    'the nonce from consumer %r.', client_key)
+            return False
+
+        # Forget the nonce if the transaction is aborted or the commit
+        # failed (e.g. ConflictError) as the request will be retried
+        # with the very same nonce.
+        transaction.get().join(NonceRelease(releaseMemoryNonce, key))
+        return True
+
+
+def releaseMemoryNonce(status, key):
+    if not status:
+        memory_nonces.pop(key, None)
+
+
+class BackendNonceManager(object):
+    """\
+    Nonce manager that keeps the nonces in the IKeyValueStore utility,
+    such that they are shared by all the processes using the store
+    without writing to the ZODB.
+    """
+
+    zope.component.adapts(IAttributeAnnotatable, IKeyValueStoreLayer)
+    zope.interface.implements(INonceManager)
+
+    # See NonceManager.
+    window = 600
+
+    def __init__(self, context, request):
+        self.context = context
+        self.request = request
+        self.store = zope.component.getUtility(IKeyValueStore)
+        getPhysicalPath = getattr(context, 'getPhysicalPath', None)
+        if getPhysicalPath is None:
+            self.prefix = None
+        else:
+            self.prefix = '/'.join(getPhysicalPath())
+
+    def check(self, client_key, timestamp, nonce, token=None, request=None):
+        now = int(time.time())
+        timestamp = checkTimestamp(timestamp, self.window, now)
+        if timestamp is None:
+            return False
+
+        ttl = timestamp + self.window - now + 1
+        key = storeKey('nonce', self.prefix, client_key, nonce)
+        if not self.store.add(key, str(timestamp), ttl):
+            return False
+
+        # See MemoryNonceManager, otherwise the retry would be rejected
+        # by every client of the store for the rest of the window.
+        transaction.get().join(
+            NonceRelease(releaseBackendNonce, self.store, key))
+        return True
+
+
+def releaseBackendNonce(status, store, key):
+    if not status:
+        store.delete(key)
@@ -16,7 +16,11 @@ from zExceptions import Forbidden
 from zExceptions import BadRequest
 
 from pmr2.oauth.interfaces import IOAuthPlugin, IOAuthRequestValidatorAdapter
-from pmr2.oauth.interfaces import ITokenManager, IScopeManager
+from pmr2.oauth.interfaces import IScopeManager, ITokenManager
+from pmr2.oauth import instrument
+from pmr2.oauth.cache import queryRequestManager
+from pmr2.oauth.utility import extractOAuthKeys, isUnknownKey
+from pmr2.oauth.utility import extractRequestURL
 from pmr2.oauth.browser.endpoints import ResourceEndpointValidator
 from pmr2.oauth.browser.endpoints import OAuth1Error
 
@@ -69,16 +73,47 @@ class OAuthPlugin(BasePlugin):
             # Skip all not OAuth related.
             return {}
 
+        started = instrument.start()
+        try:
+            return self._extractOAuthCredentials(request, started)
+        finally:
+            instrument.finish(started)
+
+    def _extractOAuthCredentials(self, request, started):
         # XXX should just return the OAuth request string, let method
         # authenticateCredentials handle the rest.
         site = getSite()
+
+        # Reject the keys recently found to be unknown before doing any
+        # of the actual work.  Only when a token is provided, as without
+        # one this is not a request for a protected resource.
+        client_key, token_key = extractOAuthKeys(request)
+        if token_key and (isUnknownKey(site, 'consumer', client_key) or
+                isUnknownKey(site, 'access_token', token_key)):
+            instrument.count('rejected_unknown')
+            if self._isTokenEndpoint(extractRequestURL(request)):
+                return {}
+            raise Forbidden('authorization failed')
+        started = instrument.record('precheck', started)
+
         try:
             endpoint = ResourceEndpointValidator(site, request)
-            if not endpoint.check_request():
+            # resolve the validator along with the managers here, so
+            # that is timed as part of the construction.
+            validator = endpoint.request_validator
+            if token_key and not self._isTokenEndpoint(
+                    extractRequestURL(request)):
+                validator.resource_owner_key = token_key
+            started = instrument.record('endpoint', started)
+            checked = endpoint.check_request()
+            started = instrument.record('check_request', started)
+            if not checked:
                 return {}
             result, oreq = endpoint.validate_protected_resource_request(
                 None, None)
+            started = instrument.record('signature', started)
         except OAuth1Error:
+            instrument.count('bad_request')
             raise BadRequest('bad oauth request')
 
         if result is None:
@@ -88,16 +123,18 @@ class OAuthPlugin(BasePlugin):
 
         if result is False:
             # See if the URI ends with a valid token end point.
-            if True in [urlsplit(oreq.uri).path.endswith(ep)
-                    for ep in self.token_endpoints]:
+            if self._isTokenEndpoint(oreq.uri):
                 # this then do nothing.
                 return {}
+            instrument.count('forbidden')
             raise Forbidden('authorization failed')
 
         # Please see _validateScope
         scope = self._validateScope(site, request,
             oreq.client_key, oreq.resource_owner_key)
+        started = instrument.record('scope', started)
         if scope is False:
+            instrument.count('forbidden')
             raise Forbidden('invalid scope')
 
         if scope is None:
@@ -105,12 +142,26 @@ class OAuthPlugin(BasePlugin):
             return {}
 
         mappings = {}
-        tokenManager = zope.component.getMultiAdapter(
-            (site, request), ITokenManager)
-        token = tokenManager.getAccessToken(oreq.resource_owner_key)
+        token = endpoint.request_validator.getAccessToken(
+            oreq.resource_owner_key)
+        instrument.record('access_token', started)
+        if token is None:
+            instrument.count('forbidden')
+            raise Forbidden('invalid access token')
+        instrument.count('authenticated')
+
+        # Buffered, so this does not turn the request into a write.
+        tokenManager = queryRequestManager(site, request, ITokenManager)
+        if tokenManager is not None:
+            tokenManager.recordUsage(token.key)
+
         mappings['userid'] = token.user
         return mappings
 
+    def _isTokenEndpoint(self, uri):
+        return True in [urlsplit(uri).path.endswith(ep)
+            for ep in self.token_endpoints]
+
     def _validateScope(self, site, request, client_key, resource_owner_key):
         # This should really be done outside of here by a customized
         # SecurityManager/Policy, which PAS will invoke some time after
@@ -122,8 +173,7 @@ class OAuthPlugin(BasePlugin):
         accessed, container, name, value = pas._getObjectContext(
             request.PUBLISHED, request)
 
-        scopeManager = zope.component.queryMultiAdapter(
-            (site, request), IScopeManager)
+        scopeManager = queryRequestManager(site, request, IScopeManager)
         if not scopeManager:
             # This normally shouldn't happen...
             return
@@ -1,5 +1,6 @@
 import re
 import logging
+import itertools
 
 from persistent import Persistent
 from BTrees.OOBTree import OOBTree
@@ -11,18 +12,210 @@ from zope.annotation.interfaces import IAttributeAnnotatable
 import zope.interface
 from zope.schema import fieldproperty
 
-from Acquisition import aq_parent, aq_inner
+from Acquisition import aq_base, aq_parent, aq_inner
 from Products.CMFCore.utils import getToolByName
 
 from pmr2.oauth.interfaces import KeyExistsError
 from pmr2.oauth.interfaces import IScopeManager, IDefaultScopeManager
 from pmr2.oauth.interfaces import IContentTypeScopeManager
 from pmr2.oauth.interfaces import IContentTypeScopeProfile
+from pmr2.oauth import instrument
 from pmr2.oauth.factory import factory
+from pmr2.oauth.shard import ShardedOOBTree
+from pmr2.oauth.cache import memoize, LRUCache
 
 _marker = object()
+# Shared default for the missing mappings, never modified.
+_empty_mapping = {}
 logger = logging.getLogger('pmr2.oauth.scope')
 
+# The targets resolved by this process, keyed by the physical path of
+# the accessed object and the name, each along with the generation it
+# was resolved in.  The entries expire such that the objects moved by
+# other processes (e.g. other ZEO clients) are eventually resolved
+# again.
+resolved_targets = LRUCache(maxsize=10000, ttl=300)
+
+# The paths of the objects moved (added or removed) within this process
+# mapped to the generation of the move, kept for as long as the targets
+# resolved before the move.
+moved_paths = LRUCache(maxsize=10000, ttl=300)
+
+_generations = itertools.count(1)
+_generation = [0]
+
+
+def targetPath(obj):
+    """
+    Return the physical path of the object as a tuple, or None if it
+    does not have one of its own (i.e. not one acquired from a parent).
+    """
+
+    if getattr(aq_base(obj), 'getPhysicalPath', None) is None:
+        return None
+    return tuple(obj.getPhysicalPath())
+
+
+def isMovedPath(path, generation):
+    """
+    Return whether the path, or any of its parents, was moved after the
+    generation.
+    """
+
+    if not len(moved_paths):
+        return False
+    for i in range(1, len(path) + 1):
+        moved = moved_paths.get(path[:i])
+        if moved is not None and moved > generation:
+            return True
+    return False
+
+
+def invalidateResolvedTargets(event):
+    """
+    Subscriber for IObjectMovedEvent (which includes additions and
+    removals) that marks the resolved targets at or beneath the old and
+    new locations of the object as stale, by noting the locations along
+    with a new generation.
+    """
+
+    if not len(resolved_targets):
+        # nothing resolved yet to be made stale.
+        return
+
+    for parent, name in ((event.oldParent, event.oldName),
+            (event.newParent, event.newName)):
+        if parent is None or name is None:
+            continue
+        path = targetPath(parent)
+        if path is None:
+            continue
+        if len(moved_paths) >= moved_paths.maxsize:
+            # the oldest moves would be forgotten while the targets
+            # resolved before them may still be cached.
+            resolved_targets.clear()
+        generation = _generation[0] = _generations.next()
+        moved_paths.set(path + (name,), generation)
+
+
+class _SubpathNode(object):
+    """
+    Node of the subpath trie, keyed by path segments.
+    """
+
+    __slots__ = ('children', 'partials', 'lengths')
+
+    def __init__(self):
+        self.children = {}
+        # prefixes of the next segment that would match.
+        self.partials = set()
+        self.lengths = set()
+
+
+class SubpathMatcher(object):
+    """
+    The subpaths permitted for a single content type, compiled.
+
+    Patterns that end with an asterisk and contain a slash match any
+    subpath starting with the pattern without the asterisk, all other
+    patterns must match exactly.  The prefixes are kept in a trie keyed
+    by the path segments, such that matching only depends on the depth
+    of the subpath rather than the number of patterns.
+    """
+
+    def __init__(self, patterns):
+        self.exact = set()
+        self.root = _SubpathNode()
+        for pattern in patterns:
+            if pattern.endswith('*') and '/' in pattern:
+                self._addPrefix(pattern[:pattern.rindex('*')])
+            else:
+                self.exact.add(pattern)
+
+    def _addPrefix(self, prefix):
+        segments = prefix.split('/')
+        node = self.root
+        for segment in segments[:-1]:
+            node = node.children.setdefault(segment, _SubpathNode())
+        node.partials.add(segments[-1])
+        node.lengths.add(len(segments[-1]))
+
+    def match(self, subpath):
+        if subpath in self.exact:
+            return True
+
+        node = self.root
+        for segment in subpath.split('/'):
+            for length in node.lengths:
+                if segment[:length] in node.partials:
+                    return True
+            node = node.children.get(segment)
+            if node is None:
+                break
+        return False
+
+
+class MappingMatcher(object):
+    """
+    A content type mapping compiled for validation.
+    """
+
+    def __init__(self, mapping):
+        self.types = {}
+        for accessed_type, patterns in mapping.items():
+            if patterns:
+                self.types[accessed_type] = SubpathMatcher(patterns)
+
+    def match(self, accessed_type, subpath):
+        matcher = self.types.get(accessed_type)
+        if matcher is None:
+            logger.debug('out of scope: %s has no mapping', accessed_type)
+            return False
+
+        if matcher.match(subpath):
+            logger.debug('subpath:%s within scope', subpath)
+            return True
+
+        logger.debug('out of scope: %s not a subpath in mapping for %s',
+            subpath, accessed_type)
+        return False
+
+
+class EffectiveScope(object):
+    """
+    The union of a number of mappings with the methods each permit,
+    compiled and keyed by (content type, method).
+    """
+
+    def __init__(self, mappings):
+        patterns = {}
+        for mapping, methods in mappings:
+            for accessed_type, subpaths in mapping.items():
+                if not subpaths:
+                    continue
+                for method in methods:
+                    patterns.setdefault((accessed_type, method), []).extend(
+                        subpaths)
+
+        self.methods = set([method for accessed_type, method in patterns])
+        self.matchers = dict([(key, SubpathMatcher(value))
+            for key, value in patterns.items()])
+
+    def match(self, accessed_type, method, subpath):
+        matcher = self.matchers.get((accessed_type, method))
+        if matcher is None:
+            logger.debug('out of scope: %s has no mapping for %s',
+                accessed_type, method)
+            return False
+
+        if matcher.match(subpath):
+            logger.debug('subpath:%s within scope', subpath)
+            return True
+
+        logger.debug('out of scope: %s not a subpath in mapping for %s',
+            subpath, accessed_type)
+        return False
+
 
 class BaseScopeManager(object):
     """
@@ -64,6 +257,9 @@ class BaseScopeManager(object):
     def delAccessScope(self, access_key):
         raise NotImplementedError()
 
+    def purgeScopes(self, keys):
+        raise NotImplementedError()
+
     def validate(self, request, client_key, access_key,
             accessed, container, name, value):
         raise NotImplementedError()
@@ -85,8 +281,11 @@ class BTreeScopeManager(Persistent, Contained, BaseScopeManager):
     client_prefix = 'client.'
     access_prefix = 'access.'
 
+    # number of trees the scopes are spread over, see ShardedOOBTree.
+    shard_count = 16
+
     def __init__(self):
-        self._scope = OOBTree()
+        self._scope = ShardedOOBTree(self.shard_count)
 
     def setScope(self, key, scope):
         if self._scope.get(key, _marker) != _marker:
@@ -131,6 +330,11 @@ class BTreeScopeManager(Persistent, Contained, BaseScopeManager):
         if result == _marker:
             raise KeyError()
 
+    def purgeScopes(self, keys):
+        for key in keys:
+            self._scope.pop(key, None)
+            self._scope.pop(self.access_prefix + key, None)
+
     def requestScope(self, request_key, raw_scope):
         """
         Requesting scope for this key.
@@ -168,6 +372,14 @@ class ContentTypeScopeManager(BTreeScopeManager):
 
     zope.interface.implements(IContentTypeScopeManager)
 
+    # Number of effective scopes cached for each connection.
+    effective_scope_cache_size = 1000
+
+    # Incremented as the mappings are added, such that the cached
+    # effective scopes can be looked up without loading the mappings.
+    # The mappings themselves are never modified once added.
+    _revision = 0
+
     default_mapping_id = fieldproperty.FieldProperty(
         IContentTypeScopeManager['default_mapping_id'])
 
@@ -208,6 +420,7 @@ class ContentTypeScopeManager(BTreeScopeManager):
         self._methods[key] = methods.split()
         if metadata is not None:
             self._mappings_metadata[key] = metadata
+        self._revision += 1
         return key
 
     def getMapping(self, mapping_id, default=_marker):
@@ -216,6 +429,32 @@ class ContentTypeScopeManager(BTreeScopeManager):
             raise KeyError()
         return result
 
+    def getEffectiveScope(self, mapping_ids):
+        """
+        Return the effective scope of the mappings identified by the
+        mapping ids.
+
+        The results are cached in a volatile attribute (i.e. for each
+        ZODB connection) keyed by the revision of the mappings, so the
+        mappings are only loaded when the effective scope is built.
+        """
+
+        cache = getattr(self, '_v_effective_scopes', None)
+        if cache is None:
+            cache = self._v_effective_scopes = LRUCache(
+                maxsize=self.effective_scope_cache_size)
+
+        mapping_ids = tuple(sorted(mapping_ids))
+        key = (self._revision, mapping_ids)
+        scope = cache.get(key)
+        if scope is None:
+            sources = [(self.getMapping(mapping_id, _empty_mapping),
+                    self.getMappingMethods(mapping_id, ()))
+                for mapping_id in mapping_ids]
+            scope = EffectiveScope(sources)
+            cache.set(key, scope)
+        return scope
+
     def getMappingMetadata(self, mapping_id, default=None):
         result = self._mappings_metadata.get(mapping_id, default)
         return result
@@ -338,18 +577,24 @@ class ContentTypeScopeManager(BTreeScopeManager):
         See IScopeManager.
         """
 
-        mappings = self.resolveMapping(client_key, access_key)
-        # multiple rights were requested, check through all of them.
-        for mapping_id in mappings:
-            mapping = self.getMapping(mapping_id, default={})
-            result = self.validateTargetWithMapping(accessed, name, mapping)
-            method_allowed = self.checkMethodPermission(mapping_id,
-                request.method)
-            if result and method_allowed:
-                return True
+        mappings = memoize(request, ('access_scope', access_key),
+            self.resolveMapping, client_key, access_key)
+        if not mappings:
+            # no scope was granted for this access key.
+            return False
 
-        # no matching mappings.
-        return False
+        # multiple rights may have been requested, check through all of
+        # them at once.
+        scope = self.getEffectiveScope(mappings)
+        if request.method not in scope.methods:
+            return False
+
+        started = instrument.start()
+        atype, subpath = self.resolveTarget(accessed, name)
+        started = instrument.record('scope_resolve', started)
+        result = scope.match(atype, request.method, subpath)
+        instrument.record('scope_match', started)
+        return result
 
     def resolveMapping(self, client_key, access_key):
         """
@@ -366,8 +611,24 @@ class ContentTypeScopeManager(BTreeScopeManager):
         Find the type of the container object of the accessed object by
         traversing upwards, and gather the path to resolve into the 
         content type id.  Return both these values.
+
+        Results are cached for the physical path of the accessed object,
+        until the object or any of its parents are moved or removed.
         """
 
+        path = targetPath(accessed)
+        if path is not None:
+            entry = resolved_targets.get((path, name))
+            if entry is not None and not isMovedPath(path, entry[0]):
+                return entry[1]
+
+        generation = _generation[0]
+        result = self._resolveTarget(accessed, name)
+        if path is not None and result[0] is not None:
+            resolved_targets.set((path, name), (generation, result))
+        return result
+
+    def _resolveTarget(self, accessed, name):
         logger.debug('resolving %s into types', accessed)
         # use getSite() instead of container?
         pt_tool = getToolByName(accessed, 'portal_types', None)
@@ -395,7 +656,10 @@ class ContentTypeScopeManager(BTreeScopeManager):
         return self.validateTypeSubpathMapping(atype, subpath, mapping)
 
     def validateTypeSubpathMapping(self, accessed_type, subpath, mapping):
-        # A simple lookup method.
+        # A simple lookup method.  The given mapping may be modified
+        # between calls and is only checked once, so compiling it would
+        # cost more than the loop; the stored mappings are compiled once
+        # by getEffectiveScope.
         valid_scopes = mapping.get(accessed_type, {})
         if not valid_scopes:
             logger.debug('out of scope: %s has no mapping', accessed_type)
@@ -403,9 +667,7 @@ class ContentTypeScopeManager(BTreeScopeManager):
         logger.debug('%s got mapping', accessed_type)
 
         for vs in valid_scopes:
-            # XXX ignores second last asterisk, preventing validation
-            # against items that have an asterisk in its name for 
-            # whatever reason...
+            # Same patterns as SubpathMatcher.
             if vs.endswith('*') and '/' in vs:
                 match = subpath.startswith(vs[:vs.rindex('*')])
             else:
@@ -69,3 +69,55 @@ def scope_upgrade_v0_4(site):
     logger.info('Purging and reinitializing the built-in token manager.')
     tm = zope.component.getMultiAdapter((site, None), ITokenManager)
     tm.__init__()
+
+def migrate_v0_4_to_v0_7(context):
+    logger = getLogger('pmr2.oauth')
+    logger.info('Migrating pmr2.oauth to v0.7.')
+    site = getSite()
+    token_upgrade_v0_7(site)
+
+def token_upgrade_v0_7(site):
+    import zope.component
+    from BTrees.IOBTree import IOBTree
+    from BTrees.OOBTree import OOBTree
+    from pmr2.oauth.interfaces import ITokenManager, IScopeManager
+    from pmr2.oauth.shard import ShardedOOBTree
+
+    logger = getLogger('pmr2.oauth')
+    tm = zope.component.getMultiAdapter((site, None), ITokenManager)
+
+    logger.info('Moving the tokens into sharded trees, with the request '
+        'tokens in their own.')
+    trees = [tm._tokens, getattr(tm, '_request_tokens', None) or {}]
+    tm._tokens = ShardedOOBTree(tm.shard_count)
+    tm._request_tokens = ShardedOOBTree(tm.shard_count)
+    for tree in trees:
+        for key, token in tree.items():
+            tm._tree(token)[key] = token
+
+    sm = zope.component.queryMultiAdapter((site, None), IScopeManager)
+    scope = getattr(sm, '_scope', None)
+    if scope is not None and not isinstance(scope, ShardedOOBTree):
+        logger.info('Moving the scopes into a sharded tree.')
+        sm._scope = ShardedOOBTree(sm.shard_count)
+        sm._scope.update(scope)
+
+    logger.info('Building the expiry index for the request tokens.')
+    tm._expiry_index = IOBTree()
+    for token in tm._request_tokens.values():
+        tm._add_expiry_index(token)
+
+    logger.info('Building the consumer and timestamp token indexes.')
+    tm._consumer_token_map = OOBTree()
+    tm._consumer_access_count = OOBTree()
+    tm._timestamp_index = IOBTree()
+    for token in tm._tokens.values():
+        tm._add_consumer_map(token)
+        tm._add_timestamp_index(token)
+
+    if getattr(tm, '_last_used', None) is None:
+        tm._last_used = OOBTree()
+
+    logger.info('Converting the user token map to hold token summaries.')
+    for user in list(tm._user_token_map.keys()):
+        tm._userTokens(user)
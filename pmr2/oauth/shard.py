@@ -0,0 +1,110 @@
+import heapq
+from zlib import crc32
+
+from persistent import Persistent
+from BTrees.OOBTree import OOBTree
+
+
+def shardOf(key, count):
+    """\
+    Return the index of the shard for the key, stable across processes
+    unlike the builtin hash.
+    """
+
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    elif not isinstance(key, str):
+        # the trees will deal with whatever this is.
+        key = repr(key)
+    return (crc32(key) & 0xffffffff) % count
+
+
+def _merge(iterables):
+    # the sorted merge of the sorted iterables.
+    heap = []
+    for i, it in enumerate([iter(i) for i in iterables]):
+        for item in it:
+            heap.append((item, i, it))
+            break
+    heapq.heapify(heap)
+    while heap:
+        item, i, it = heap[0]
+        yield item
+        for item in it:
+            heapq.heapreplace(heap, (item, i, it))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+class ShardedOOBTree(Persistent):
+    """\
+    An OOBTree split into a number of OOBTrees, with each key kept in
+    the one selected by the hash of the key.
+
+    Concurrent insertions are spread over the trees, so that the bucket
+    splits of one tree (which cannot be resolved on conflict) only
+    conflict with the insertions into that tree.  This object itself is
+    not written to after creation.
+
+    Provides the subset of the OOBTree API used by the managers, with
+    the keys, values and items iterated in key order across the trees.
+    """
+
+    def __init__(self, count=16):
+        self._shards = tuple([OOBTree() for i in range(count)])
+
+    def _shard(self, key):
+        return self._shards[shardOf(key, len(self._shards))]
+
+    def get(self, key, default=None):
+        return self._shard(key).get(key, default)
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def __setitem__(self, key, value):
+        self._shard(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._shard(key)[key]
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    has_key = __contains__
+
+    def insert(self, key, value):
+        return self._shard(key).insert(key, value)
+
+    def pop(self, key, *a):
+        return self._shard(key).pop(key, *a)
+
+    def update(self, items):
+        if hasattr(items, 'items'):
+            items = items.items()
+        for key, value in items:
+            self[key] = value
+
+    # Unlike the OOBTree these return iterators, as the merge is lazy.
+
+    def keys(self, *a, **kw):
+        return _merge([s.keys(*a, **kw) for s in self._shards])
+
+    def items(self, *a, **kw):
+        return _merge([s.items(*a, **kw) for s in self._shards])
+
+    def values(self, *a, **kw):
+        return (value for key, value in self.items(*a, **kw))
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        return sum([len(s) for s in self._shards])
+
+    def __nonzero__(self):
+        for s in self._shards:
+            if s:
+                return True
+        return False
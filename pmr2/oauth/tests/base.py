@@ -6,6 +6,7 @@ from sys import maxint
 from cStringIO import StringIO
 
 from oauthlib.oauth1 import Client
+from oauthlib.oauth1 import SIGNATURE_HMAC
 from oauthlib.common import Request
 
 import zope.interface
@@ -95,6 +96,7 @@ class TestRequest(pmr2.z3cform.tests.base.TestRequest):
 def SignedTestRequest(form=None, consumer=None, token=None, method=None,
         url=None, callback=None, timestamp=None, verifier=None,
         signature_type='AUTH_HEADER', raw_body=None,
+        signature_method=SIGNATURE_HMAC, rsa_key=None,
         *a, **kw):
     """\
     Creates a signed TestRequest
@@ -135,6 +137,8 @@ def SignedTestRequest(form=None, consumer=None, token=None, method=None,
         verifier=safe_unicode(verifier),
         timestamp=timestamp,
         signature_type=signature_type,
+        signature_method=signature_method,
+        rsa_key=rsa_key,
     )
 
     if result.getHeader('Content-Type') == 'application/x-www-form-urlencoded':
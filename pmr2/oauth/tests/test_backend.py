@@ -0,0 +1,166 @@
+import time
+import unittest
+
+import transaction
+
+import zope.component
+import zope.interface
+from zope.annotation.interfaces import IAttributeAnnotatable
+from zope.annotation.attribute import AttributeAnnotations
+
+from pmr2.oauth.interfaces import *
+from pmr2.oauth.backend import LocalStore, MemcachedStore, StandInServer
+from pmr2.oauth.backend import storeKey
+from pmr2.oauth.nonce import BackendNonceManager, releaseBackendNonce
+from pmr2.oauth.token import KeyValueTokenManager, TokenManager
+
+from pmr2.oauth.tests.base import TestRequest
+
+
+class Site(object):
+    zope.interface.implements(IAttributeAnnotatable)
+
+    def getPhysicalPath(self):
+        return ('', 'site')
+
+
+class TestMemcachedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer().start()
+        self.store = MemcachedStore(self.server.address)
+
+    def tearDown(self):
+        self.store.close()
+        self.server.stop()
+
+    def test_000_get_set(self):
+        self.assertEqual(self.store.get('key'), None)
+        self.assertTrue(self.store.set('key', 'value'))
+        self.assertEqual(self.store.get('key'), 'value')
+        self.assertTrue(self.store.set('key', 'a\r\nb'))
+        self.assertEqual(self.store.get('key'), 'a\r\nb')
+
+    def test_001_add(self):
+        self.assertTrue(self.store.add('key', 'value', 60))
+        self.assertFalse(self.store.add('key', 'other', 60))
+        self.assertEqual(self.store.get('key'), 'value')
+
+    def test_002_delete(self):
+        self.store.set('key', 'value')
+        self.assertTrue(self.store.delete('key'))
+        self.assertFalse(self.store.delete('key'))
+        self.assertEqual(self.store.get('key'), None)
+
+    def test_003_store_key(self):
+        key = storeKey('nonce', None, u'client key', u'nonce')
+        self.assertFalse(' ' in key)
+        self.assertNotEqual(key, storeKey('nonce', None, u'client', u'nonce'))
+        self.assertTrue(self.store.add(key, '1', 60))
+
+
+class TestBackendManagers(unittest.TestCase):
+
+    def setUp(self):
+        self.store = LocalStore()
+        zope.component.provideAdapter(AttributeAnnotations)
+        zope.component.provideUtility(self.store, IKeyValueStore)
+        self.site = Site()
+        self.request = TestRequest()
+        zope.interface.alsoProvides(self.request, IKeyValueStoreLayer)
+
+    def tearDown(self):
+        transaction.abort()
+        zope.component.getGlobalSiteManager().unregisterUtility(
+            self.store, IKeyValueStore)
+
+    def test_000_nonce(self):
+        m = BackendNonceManager(self.site, self.request)
+        now = str(int(time.time()))
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+        self.assertFalse(m.check(u'client', now, u'nonce'))
+        self.assertTrue(m.check(u'client', now, u'nonce2'))
+        self.assertFalse(m.check(u'client', '0', u'nonce3'))
+
+        key = storeKey('nonce', m.prefix, u'client', u'nonce')
+        releaseBackendNonce(False, self.store, key)
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+
+    def test_001_nonce_release_aborted(self):
+        m = BackendNonceManager(self.site, self.request)
+        now = str(int(time.time()))
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+        transaction.abort()
+        key = storeKey('nonce', m.prefix, u'client', u'nonce')
+        self.assertEqual(self.store.get(key), None)
+        # the retried request is accepted, and is kept once committed.
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+        transaction.commit()
+        self.assertEqual(self.store.get(key), now)
+        self.assertFalse(m.check(u'client', now, u'nonce'))
+
+    def test_100_request_token_in_store(self):
+        m = KeyValueTokenManager(self.site, self.request)
+        token = m.generateRequestToken('consumer-key', 'oob')
+        # not stored persistently.
+        self.assertEqual(m.tokens.get(token.key), None)
+
+        result = m.getRequestToken(token.key)
+        self.assertEqual(result.key, token.key)
+        self.assertEqual(result.secret, token.secret)
+        self.assertEqual(result.verifier, token.verifier)
+        self.assertEqual(result.consumer_key, 'consumer-key')
+        self.assertEqual(result.callback, 'oob')
+        self.assertEqual(result.user, None)
+        self.assertEqual(m.get(token.key).key, token.key)
+        self.assertRaises(NotAccessTokenError, m.getAccessToken, token.key)
+
+    def test_101_request_token_exchange(self):
+        m = KeyValueTokenManager(self.site, self.request)
+        token = m.generateRequestToken('consumer-key', 'oob')
+        self.assertRaises(TokenInvalidError, m.generateAccessToken,
+            'consumer-key', token.key)
+        self.assertFalse(m.requestTokenVerify('consumer-key', token.key,
+            token.verifier))
+
+        m.claimRequestToken(token.key, 'user')
+        self.assertEqual(m.getRequestToken(token.key).user, 'user')
+        self.assertTrue(m.requestTokenVerify('consumer-key', token.key,
+            token.verifier))
+
+        access = m.generateAccessToken('consumer-key', token.key)
+        self.assertEqual(m.tokens.getAccessToken(access.key), access)
+        self.assertEqual(m.getAccessToken(access.key), access)
+        self.assertEqual(m.getTokensForUser('user'), [access])
+
+        m.remove(token.key)
+        self.assertEqual(m.get(token.key), None)
+        self.assertRaises(TokenInvalidError, m.getRequestToken, token.key)
+
+    def test_102_persistent_request_token(self):
+        m = KeyValueTokenManager(self.site, self.request)
+        tm = m.tokens
+        token = tm.generateRequestToken('consumer-key', 'oob')
+        self.assertEqual(m.getRequestToken(token.key), token)
+        m.claimRequestToken(token, 'user')
+        self.assertEqual(token.user, 'user')
+        m.remove(token)
+        self.assertEqual(tm.get(token.key), None)
+
+    def test_200_selected_by_layer(self):
+        zope.component.provideAdapter(BackendNonceManager)
+        zope.component.provideAdapter(KeyValueTokenManager)
+        m = zope.component.getMultiAdapter((self.site, self.request),
+            INonceManager)
+        self.assertTrue(isinstance(m, BackendNonceManager))
+        m = zope.component.getMultiAdapter((self.site, self.request),
+            ITokenManager)
+        self.assertTrue(isinstance(m, KeyValueTokenManager))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestMemcachedStore))
+    suite.addTest(makeSuite(TestBackendManagers))
+    return suite
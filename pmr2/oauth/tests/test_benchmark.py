@@ -0,0 +1,52 @@
+import unittest
+
+from pmr2.oauth.benchmark import Benchmark, percentile, summarize
+from pmr2.oauth.benchmark import conflictRates
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_0000_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([5], 90), 5)
+        self.assertEqual(percentile([], 90), None)
+
+    def test_0001_summarize(self):
+        result = summarize([0.002, 0.001, 0.003, 0.002])
+        self.assertEqual(result['count'], 4)
+        self.assertAlmostEqual(result['throughput'], 500)
+        self.assertAlmostEqual(result['latency_ms']['p50'], 2)
+        self.assertAlmostEqual(result['latency_ms']['max'], 3)
+        self.assertEqual(summarize([])['latency_ms'], None)
+
+    def test_0100_run(self):
+        benchmark = Benchmark(consumers=2, users=2, tokens_per_user=2,
+            mapping_size=3, depth=2, seed=0)
+        result = benchmark.run(iterations=3)
+        self.assertEqual(result['config']['consumers'], 2)
+        self.assertEqual(sorted(result['results'].keys()), [
+            'access_token', 'claim_token', 'protected_resource',
+            'request_token'])
+        for value in result['results'].values():
+            self.assertEqual(value['count'], 3)
+
+    def test_0200_conflicts(self):
+        result = conflictRates(concurrency=(1, 4), shards=(1, 4), rounds=3,
+            prefill=100, seed=0)
+        self.assertEqual(sorted(result['shards'].keys()), ['1', '4'])
+        for rates in result['shards'].values():
+            self.assertEqual(rates['1']['conflicts'], 0)
+            self.assertEqual(rates['1']['conflict_rate'], 0)
+            self.assertEqual(rates['1']['commits'], 3)
+            self.assertEqual(
+                rates['4']['commits'] + rates['4']['conflicts'], 12)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(BenchmarkTestCase))
+    return suite
@@ -0,0 +1,210 @@
+import unittest
+
+import zope.component
+from zope.interface import Interface
+from zope.annotation.attribute import AttributeAnnotations
+from zope.component.interfaces import ComponentLookupError
+
+from pmr2.oauth.interfaces import *
+from pmr2.oauth.cache import getRequestCache
+from pmr2.oauth.cache import getRequestManager, queryRequestManager
+from pmr2.oauth.cache import memoize, invalidate
+from pmr2.oauth.cache import LRUCache, ExpiringCache
+
+from pmr2.oauth.consumer import ConsumerManager
+from pmr2.oauth.token import Token
+from pmr2.oauth.token import TokenManager
+from pmr2.oauth.utility import SiteRequestValidatorAdapter
+
+from pmr2.oauth.tests.base import IOAuthTestLayer
+from pmr2.oauth.tests.base import TestRequest
+from pmr2.oauth.tests.adapter import TestCallbackManager
+
+
+class ICountedManager(Interface):
+    """\
+    Marker for the counted manager.
+    """
+
+
+class IMissing(Interface):
+    """\
+    Nothing provides this.
+    """
+
+
+class CountedManager(object):
+
+    created = 0
+
+    def __init__(self, context, request):
+        CountedManager.created += 1
+
+
+class TestRequestCache(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.provideAdapter(AttributeAnnotations)
+        zope.component.provideAdapter(CountedManager,
+            (Interface, IOAuthTestLayer), ICountedManager)
+        CountedManager.created = 0
+
+    def test_0000_no_request(self):
+        cache = getRequestCache(None)
+        cache['a'] = 1
+        self.assertEqual(getRequestCache(None), {})
+
+    def test_0001_request_cache(self):
+        request = TestRequest()
+        cache = getRequestCache(request)
+        cache['a'] = 1
+        self.assertEqual(getRequestCache(request), {'a': 1})
+        self.assertEqual(getRequestCache(TestRequest()), {})
+
+    def test_0100_manager_once_per_request(self):
+        request = TestRequest()
+        site = object()
+        m1 = getRequestManager(site, request, ICountedManager)
+        m2 = getRequestManager(site, request, ICountedManager)
+        self.assertTrue(m1 is m2)
+        self.assertEqual(CountedManager.created, 1)
+
+        # different request, different manager.
+        m3 = getRequestManager(site, TestRequest(), ICountedManager)
+        self.assertFalse(m1 is m3)
+
+        # different site, different manager.
+        m4 = getRequestManager(object(), request, ICountedManager)
+        self.assertFalse(m1 is m4)
+        self.assertEqual(CountedManager.created, 3)
+
+    def test_0101_manager_missing(self):
+        request = TestRequest()
+        self.assertEqual(queryRequestManager(object, request, IMissing),
+            None)
+        self.assertRaises(ComponentLookupError,
+            getRequestManager, object, request, IMissing)
+
+    def test_0200_memoize(self):
+        request = TestRequest()
+        calls = []
+        def func(value):
+            calls.append(value)
+            return value
+        self.assertEqual(memoize(request, 'key', func, 1), 1)
+        self.assertEqual(memoize(request, 'key', func, 2), 1)
+        self.assertEqual(calls, [1])
+        invalidate(request, 'key')
+        self.assertEqual(memoize(request, 'key', func, 2), 2)
+        self.assertEqual(calls, [1, 2])
+
+    def test_0300_validator_memoized_lookups(self):
+        tm = TokenManager()
+        token = Token('token-key', 'token-secret')
+        token.access = True
+        token.user = 'user'
+        tm.add(token)
+        cm = ConsumerManager()
+        zope.component.provideAdapter(lambda c, r: tm,
+            (Interface, IOAuthTestLayer), ITokenManager)
+        zope.component.provideAdapter(lambda c, r: cm,
+            (Interface, IOAuthTestLayer), IConsumerManager)
+        zope.component.provideAdapter(TestCallbackManager,
+            (Interface, IOAuthTestLayer), ICallbackManager)
+        zope.component.provideAdapter(SiteRequestValidatorAdapter,
+            (Interface, IOAuthTestLayer), IOAuthRequestValidatorAdapter)
+
+        request = TestRequest()
+        validator = zope.component.getMultiAdapter(
+            (object, request), IOAuthRequestValidatorAdapter)
+        self.assertEqual(validator.getAccessToken('token-key'), token)
+        tm.remove(token)
+        # still the same token for the rest of this request.
+        self.assertEqual(validator.getAccessToken('token-key'), token)
+
+        validator = zope.component.getMultiAdapter(
+            (object, TestRequest()), IOAuthRequestValidatorAdapter)
+        self.assertEqual(validator.getAccessToken('token-key'), None)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.cache = LRUCache(maxsize=3, timer=lambda: self.now)
+
+    def test_0000_get_set(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertTrue('a' in self.cache)
+        self.assertEqual(self.cache.pop('a'), 1)
+        self.assertFalse('a' in self.cache)
+
+    def test_0001_bounded(self):
+        for k in 'abc':
+            self.cache.set(k, k)
+        # touch a so b becomes least recently used.
+        self.cache.get('a')
+        self.cache.set('d', 'd')
+        self.assertEqual(len(self.cache), 3)
+        self.assertFalse('b' in self.cache)
+        self.assertEqual(sorted(self.cache.keys()), ['a', 'c', 'd'])
+
+    def test_0002_ttl(self):
+        self.cache.set('a', 1, ttl=10)
+        self.cache.set('b', 2)
+        self.now += 10
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 2)
+
+    def test_0003_add(self):
+        self.assertTrue(self.cache.add('a', 1, ttl=10))
+        self.assertFalse(self.cache.add('a', 2))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.now += 10
+        self.assertTrue(self.cache.add('a', 2))
+        self.assertEqual(self.cache.get('a'), 2)
+
+    def test_0004_clear(self):
+        self.cache.set('a', 1)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.cache.set('b', 1)
+        self.assertEqual(self.cache.keys(), ['b'])
+
+
+class TestExpiringCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.cache = ExpiringCache(maxsize=3, timer=lambda: self.now)
+
+    def test_0000_full_of_live_entries(self):
+        self.assertTrue(self.cache.add('a', 1, ttl=10))
+        self.assertTrue(self.cache.add('b', 2, ttl=20))
+        self.assertTrue(self.cache.set('c', 3, ttl=20))
+        self.assertFalse(self.cache.add('d', 4, ttl=20))
+        self.assertFalse(self.cache.set('d', 4, ttl=20))
+        self.assertEqual(sorted(self.cache.keys()), ['a', 'b', 'c'])
+        # existing keys can still be replaced.
+        self.assertTrue(self.cache.set('c', 5, ttl=20))
+        self.assertEqual(self.cache.get('c'), 5)
+
+    def test_0001_expired_discarded(self):
+        self.cache.add('a', 1, ttl=10)
+        self.cache.add('b', 2, ttl=20)
+        self.cache.add('c', 3, ttl=20)
+        self.now += 10
+        self.assertTrue(self.cache.add('d', 4, ttl=20))
+        self.assertEqual(sorted(self.cache.keys()), ['b', 'c', 'd'])
+        self.assertFalse(self.cache.add('e', 5, ttl=20))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestRequestCache))
+    suite.addTest(makeSuite(TestLRUCache))
+    suite.addTest(makeSuite(TestExpiringCache))
+    return suite
@@ -0,0 +1,72 @@
+import unittest
+
+from pmr2.oauth import instrument
+
+
+class InstrumentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.timer = instrument.timer
+        self.now = [100.0]
+        instrument.timer = lambda: self.now[0]
+        instrument.stats.reset()
+
+    def tearDown(self):
+        instrument.timer = self.timer
+        instrument.disable()
+        instrument.stats.reset()
+
+    def test_0000_disabled(self):
+        started = instrument.start()
+        self.assertEqual(started, None)
+        self.assertEqual(instrument.record('stage', started), None)
+        instrument.count('counter')
+        instrument.finish(started)
+        snapshot = instrument.stats.snapshot()
+        self.assertEqual(snapshot['timings'], {})
+        self.assertEqual(snapshot['counters'], {})
+
+    def test_0001_record(self):
+        instrument.enable()
+        started = instrument.start()
+        self.now[0] += 0.002
+        started = instrument.record('first', started)
+        self.now[0] += 0.2
+        instrument.record('second', started)
+        self.now[0] += 2
+        started = instrument.record('second', started)
+        instrument.count('counter')
+        instrument.count('counter', 2)
+
+        snapshot = instrument.stats.snapshot()
+        self.assertTrue(snapshot['enabled'])
+        self.assertEqual(snapshot['counters'], {'counter': 3})
+        first = snapshot['timings']['first']
+        self.assertEqual(first['count'], 1)
+        self.assertAlmostEqual(first['max_ms'], 2)
+        self.assertEqual(first['histogram']['2.5'], 1)
+        second = snapshot['timings']['second']
+        self.assertEqual(second['count'], 2)
+        self.assertEqual(second['histogram']['250'], 1)
+        self.assertEqual(second['histogram']['inf'], 1)
+
+    def test_0002_finish_logs(self):
+        logged = []
+        original = instrument.logStats
+        instrument.logStats = lambda: logged.append(True)
+        try:
+            instrument.enable(log_interval=2)
+            for i in range(5):
+                instrument.finish(instrument.start())
+        finally:
+            instrument.logStats = original
+        self.assertEqual(len(logged), 2)
+        self.assertEqual(
+            instrument.stats.snapshot()['timings']['total']['count'], 5)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(InstrumentTestCase))
+    return suite
@@ -6,6 +6,7 @@ from BTrees.OOBTree import OOBTree
 from Products.PloneTestCase import ptc
 
 from pmr2.oauth.interfaces import ITokenManager
+from pmr2.oauth.shard import ShardedOOBTree
 
 from pmr2.oauth.tests import base
 
@@ -40,8 +41,62 @@ class MigrationV04TestCase(ptc.PloneTestCase):
         self.assertFalse('pmr2.oauth.scope.DefaultScopeManager' in ants)
 
 
+class MigrationV07TestCase(ptc.PloneTestCase):
+    """
+    Test case for migration from v0.4 to v0.7
+    """
+
+    def afterSetUp(self):
+        from persistent.list import PersistentList
+        from pmr2.oauth.token import Token
+        tm = zope.component.getMultiAdapter((self.portal, None), ITokenManager)
+        # Simulate the token manager from before the indexes.
+        del tm._expiry_index
+        del tm._consumer_token_map
+        del tm._consumer_access_count
+        del tm._last_used
+        del tm._request_tokens
+        del tm._timestamp_index
+        tm._tokens = OOBTree()
+        tm._user_token_map['user'] = PersistentList(['access-token'])
+        for i in range(3):
+            token = Token('request-%d' % i, 'secret')
+            token.expiry = 1000 + i
+            tm._tokens[token.key] = token
+        token = Token('access-token', 'secret')
+        token.access = True
+        token.user = 'user'
+        token.consumer_key = 'consumer'
+        token.timestamp = 1000
+        tm._tokens[token.key] = token
+
+    def test_0000_migration(self):
+        from pmr2.oauth.setuphandlers import token_upgrade_v0_7
+        tm = zope.component.getMultiAdapter((self.portal, None), ITokenManager)
+        token_upgrade_v0_7(self.portal)
+        self.assertEqual(sorted(tm._request_tokens.keys()),
+            ['request-0', 'request-1', 'request-2'])
+        self.assertFalse('request-0' in tm._tokens)
+        self.assertTrue(isinstance(tm._tokens, ShardedOOBTree))
+        self.assertTrue(isinstance(tm._request_tokens, ShardedOOBTree))
+        removed = tm.purgeExpiredTokens(2000)
+        self.assertEqual(sorted(removed),
+            ['request-0', 'request-1', 'request-2'])
+        self.assertTrue(tm.get('access-token'))
+        self.assertTrue(isinstance(tm._user_token_map['user'], OOBTree))
+        self.assertEqual(tm._user_token_map['user']['access-token'],
+            ('consumer', 1000))
+        self.assertEqual(tm.getAccessToken('access-token').user, 'user')
+        self.assertEqual(len(tm.getTokensForUser('user')), 1)
+        self.assertEqual(tm.countTokensForConsumer('consumer'), 1)
+        self.assertEqual(tm.getLastUsed('access-token'), None)
+        self.assertEqual(tm.revokeTokensBefore(2000), ['access-token'])
+        self.assertFalse('consumer' in tm._consumer_token_map)
+
+
 def test_suite():
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
     suite.addTest(makeSuite(MigrationV04TestCase))
+    suite.addTest(makeSuite(MigrationV07TestCase))
     return suite
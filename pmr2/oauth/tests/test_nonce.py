@@ -0,0 +1,216 @@
+import time
+import unittest
+
+import transaction
+
+import zope.component
+import zope.interface
+from zope.interface import Interface
+from zope.annotation.interfaces import IAttributeAnnotatable
+from zope.annotation.attribute import AttributeAnnotations
+
+from pmr2.oauth.interfaces import *
+from pmr2.oauth.nonce import NonceManager
+from pmr2.oauth.nonce import MemoryNonceManager, releaseMemoryNonce
+from pmr2.oauth.nonce import NonceRelease
+from pmr2.oauth.nonce import memory_nonces
+from pmr2.oauth.utility import SiteRequestValidatorAdapter
+
+from pmr2.oauth.consumer import ConsumerManager
+from pmr2.oauth.token import TokenManager
+
+from pmr2.oauth.tests.base import IOAuthTestLayer
+from pmr2.oauth.tests.base import TestRequest
+from pmr2.oauth.tests.adapter import TestCallbackManager
+
+
+class Site(object):
+    zope.interface.implements(IAttributeAnnotatable)
+
+    def getPhysicalPath(self):
+        return ('', 'site')
+
+
+class TestNonceManager(unittest.TestCase):
+
+    def test_000_check(self):
+        m = NonceManager()
+        now = str(int(time.time()))
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+        self.assertFalse(m.check(u'client', now, u'nonce'))
+        # different combinations are different nonces.
+        self.assertTrue(m.check(u'client2', now, u'nonce'))
+        self.assertTrue(m.check(u'client', now, u'nonce', u'token'))
+        self.assertFalse(m.check(u'client', now, u'nonce', u'token'))
+        self.assertTrue(m.check(u'client', now, u'nonce2'))
+
+    def test_001_check_stale(self):
+        m = NonceManager()
+        now = int(time.time())
+        self.assertFalse(m.check(u'client', now - m.window - 1, u'nonce'))
+        self.assertFalse(m.check(u'client', now + m.window + 1, u'nonce'))
+        self.assertFalse(m.check(u'client', 'invalid', u'nonce'))
+        self.assertFalse(m.check(u'client', None, u'nonce'))
+        self.assertEqual(len(m._buckets), 0)
+
+    def test_002_check_spread(self):
+        m = NonceManager()
+        now = int(time.time())
+        for i in range(32):
+            self.assertTrue(m.check(u'client', now, u'nonce%d' % i))
+        self.assertTrue(len(m._buckets) > 1)
+        slot = now // m.bucket_size * m.shard_count
+        self.assertEqual(list(m._buckets.keys(min=slot,
+            max=slot + m.shard_count - 1)), list(m._buckets.keys()))
+        self.assertEqual(sum(len(v) for v in m._buckets.values()), 32)
+        for i in range(32):
+            self.assertFalse(m.check(u'client', now, u'nonce%d' % i))
+
+    def test_100_purge(self):
+        m = NonceManager()
+        now = int(time.time())
+        # same nonce, so both are in the same shard of their slices.
+        self.assertTrue(m.check(u'client', now - m.window, u'nonce'))
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+        self.assertEqual(m.purge(now), 0)
+        self.assertEqual(m.purge(now + m.bucket_size * 2), 1)
+        self.assertEqual(len(m._buckets), 1)
+        self.assertEqual(m.purge(now + m.window + m.bucket_size), 1)
+        self.assertEqual(len(m._buckets), 0)
+
+
+class TestMemoryNonceManager(unittest.TestCase):
+
+    def setUp(self):
+        memory_nonces.clear()
+
+    def tearDown(self):
+        transaction.abort()
+        memory_nonces.clear()
+
+    def test_000_check(self):
+        m = MemoryNonceManager(object(), TestRequest())
+        now = str(int(time.time()))
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+        self.assertFalse(m.check(u'client', now, u'nonce'))
+        self.assertTrue(m.check(u'client2', now, u'nonce'))
+        self.assertTrue(m.check(u'client', now, u'nonce2'))
+
+        # Shared by the process.
+        m = MemoryNonceManager(object(), TestRequest())
+        self.assertFalse(m.check(u'client', now, u'nonce'))
+
+    def test_001_check_stale(self):
+        m = MemoryNonceManager(object(), TestRequest())
+        now = int(time.time())
+        self.assertFalse(m.check(u'client', now - m.window - 1, u'nonce'))
+        self.assertFalse(m.check(u'client', now + m.window + 1, u'nonce'))
+        self.assertFalse(m.check(u'client', 'invalid', u'nonce'))
+        self.assertEqual(len(memory_nonces), 0)
+
+    def test_002_release_failed_commit(self):
+        m = MemoryNonceManager(object(), TestRequest())
+        now = str(int(time.time()))
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+        releaseMemoryNonce(False, (m.prefix, u'client', u'nonce'))
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+        releaseMemoryNonce(True, (m.prefix, u'client', u'nonce'))
+        self.assertFalse(m.check(u'client', now, u'nonce'))
+
+    def test_003_release_aborted(self):
+        m = MemoryNonceManager(object(), TestRequest())
+        now = str(int(time.time()))
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+        # e.g. the publisher aborting on ConflictError before a retry.
+        transaction.abort()
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+        transaction.commit()
+        self.assertFalse(m.check(u'client', now, u'nonce'))
+
+    def test_004_release_failed_vote(self):
+        class FailingVote(NonceRelease):
+            def tpc_vote(self, txn):
+                raise ValueError('failed')
+
+        m = MemoryNonceManager(object(), TestRequest())
+        now = str(int(time.time()))
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+        transaction.get().join(FailingVote(lambda status: None))
+        self.assertRaises(ValueError, transaction.commit)
+        transaction.abort()
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+
+    def test_005_savepoint(self):
+        m = MemoryNonceManager(object(), TestRequest())
+        now = str(int(time.time()))
+        self.assertTrue(m.check(u'client', now, u'nonce'))
+        transaction.savepoint().rollback()
+        self.assertFalse(m.check(u'client', now, u'nonce'))
+
+    def test_006_cache_full(self):
+        m = MemoryNonceManager(object(), TestRequest())
+        now = str(int(time.time()))
+        maxsize = memory_nonces.maxsize
+        memory_nonces.maxsize = 3
+        try:
+            for nonce in (u'nonce1', u'nonce2', u'nonce3'):
+                self.assertTrue(m.check(u'client', now, nonce))
+            # the live nonces are kept rather than making room for new
+            # ones, so none of them can be replayed.
+            self.assertFalse(m.check(u'client', now, u'nonce4'))
+            self.assertFalse(m.check(u'client', now, u'nonce1'))
+            self.assertEqual(len(memory_nonces), 3)
+        finally:
+            memory_nonces.maxsize = maxsize
+
+    def test_100_selected_by_layer(self):
+        zope.component.provideAdapter(MemoryNonceManager)
+        request = TestRequest()
+        zope.interface.alsoProvides(request, IMemoryNonceManagerLayer)
+        site = Site()
+        m = zope.component.getMultiAdapter((site, request), INonceManager)
+        self.assertTrue(isinstance(m, MemoryNonceManager))
+
+
+class TestNonceValidation(unittest.TestCase):
+
+    def setUp(self):
+        nm = NonceManager()
+        zope.component.provideAdapter(AttributeAnnotations)
+        zope.component.provideAdapter(lambda c, r: TokenManager(),
+            (Interface, IOAuthTestLayer), ITokenManager)
+        zope.component.provideAdapter(lambda c, r: ConsumerManager(),
+            (Interface, IOAuthTestLayer), IConsumerManager)
+        zope.component.provideAdapter(TestCallbackManager,
+            (Interface, IOAuthTestLayer), ICallbackManager)
+        zope.component.provideAdapter(lambda c, r: nm,
+            (Interface, IOAuthTestLayer), INonceManager)
+
+    def tearDown(self):
+        zope.component.getGlobalSiteManager().unregisterAdapter(
+            required=(Interface, IOAuthTestLayer), provided=INonceManager)
+
+    def test_000_same_request(self):
+        now = unicode(int(time.time()))
+        request = TestRequest()
+        validator = SiteRequestValidatorAdapter(object, request)
+        self.assertTrue(validator.validate_timestamp_and_nonce(
+            u'client', now, u'nonce', None, access_token=u'token'))
+        # validating the same request again is fine.
+        self.assertTrue(validator.validate_timestamp_and_nonce(
+            u'client', now, u'nonce', None, access_token=u'token'))
+
+        # but not when replayed with a new request.
+        request = TestRequest()
+        validator = SiteRequestValidatorAdapter(object, request)
+        self.assertFalse(validator.validate_timestamp_and_nonce(
+            u'client', now, u'nonce', None, access_token=u'token'))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestNonceManager))
+    suite.addTest(makeSuite(TestMemoryNonceManager))
+    suite.addTest(makeSuite(TestNonceValidation))
+    return suite
@@ -5,6 +5,11 @@ from zope.interface import Interface
 import zope.component
 from zope.schema.interfaces import WrongType, WrongContainedType
 
+from zope.lifecycleevent import ObjectMovedEvent
+
+from Acquisition import aq_base
+from OFS.Folder import Folder
+from OFS.SimpleItem import SimpleItem
 from zExceptions import Forbidden
 from zExceptions import BadRequest
 
@@ -14,6 +19,9 @@ from pmr2.oauth.interfaces import KeyExistsError
 from pmr2.oauth.interfaces import IDefaultScopeManager
 from pmr2.oauth.scope import BTreeScopeManager, ContentTypeScopeManager
 from pmr2.oauth.scope import ContentTypeScopeProfile
+from pmr2.oauth.scope import MappingMatcher, SubpathMatcher
+from pmr2.oauth.scope import resolved_targets, invalidateResolvedTargets
+from pmr2.oauth.scope import moved_paths
 
 from pmr2.oauth.tests import base
 
@@ -85,6 +93,16 @@ class BTreeScopeManagerTestCase(unittest.TestCase):
         self.assertEqual(self.sm.getAccessScope(self.access), scope2)
 
 
+    def test_0030_purge(self):
+        self.sm.setScope('token1', 'pending')
+        self.sm.setAccessScope('token2', 'access')
+        self.sm.setClientScope(self.client, 'client')
+        self.sm.purgeScopes(['token1', 'token2', 'missing'])
+        self.assertEqual(self.sm.getScope('token1', None), None)
+        self.assertEqual(self.sm.getAccessScope('token2', None), None)
+        self.assertEqual(self.sm.getClientScope(self.client), 'client')
+
+
 class CTSMMappingTestCase(unittest.TestCase):
     """
     Testing the profile and management within this scope manager.
@@ -200,6 +218,263 @@ class CTSMEditingTestCase(unittest.TestCase):
         self.assertEqual(self.sm.getMappingByName('file', default=None), None)
 
 
+class CTSMMatcherTestCase(unittest.TestCase):
+    """
+    Testing the compiled mappings.
+    """
+
+    def test_0000_exact(self):
+        matcher = MappingMatcher({'Folder': ['folder_contents', 'test_*']})
+        self.assertTrue(matcher.match('Folder', 'folder_contents'))
+        self.assertTrue(matcher.match('Folder', 'test_*'))
+        self.assertFalse(matcher.match('Folder', 'test_view'))
+        self.assertFalse(matcher.match('Folder', 'folder_content'))
+        self.assertFalse(matcher.match('Document', 'folder_contents'))
+        self.assertFalse(matcher.match(None, None))
+
+    def test_0001_prefix(self):
+        matcher = MappingMatcher({
+            'Plone Site': ['test/test_*', 'example/*', 'a/b/c*', 'x/*/y*'],
+        })
+        self.assertTrue(matcher.match('Plone Site', 'test/test_'))
+        self.assertTrue(matcher.match('Plone Site', 'test/test_view'))
+        self.assertTrue(matcher.match('Plone Site', 'test/test_a/b'))
+        self.assertFalse(matcher.match('Plone Site', 'test/test'))
+        self.assertFalse(matcher.match('Plone Site', 'test'))
+        self.assertTrue(matcher.match('Plone Site', 'example/'))
+        self.assertTrue(matcher.match('Plone Site', 'example/a/b'))
+        self.assertFalse(matcher.match('Plone Site', 'example'))
+        self.assertTrue(matcher.match('Plone Site', 'a/b/c'))
+        self.assertTrue(matcher.match('Plone Site', 'a/b/cd/e'))
+        self.assertFalse(matcher.match('Plone Site', 'a/b'))
+        self.assertFalse(matcher.match('Plone Site', 'a/bc'))
+        # only the last asterisk is special.
+        self.assertTrue(matcher.match('Plone Site', 'x/*/y'))
+        self.assertFalse(matcher.match('Plone Site', 'x/z/y'))
+
+    def test_0002_same_as_linear_scan(self):
+        def linear(patterns, subpath):
+            for vs in patterns:
+                if vs.endswith('*') and '/' in vs:
+                    if subpath.startswith(vs[:vs.rindex('*')]):
+                        return True
+                elif subpath == vs:
+                    return True
+            return False
+
+        patterns = ['a', 'a/*', 'a/b*', 'ab/c/*', 'b/', 'b/c', 'c*', '/*',
+            'd/e/f*', '*', '']
+        subpaths = ['', 'a', 'a/', 'a/b', 'a/bc', 'ab', 'ab/c', 'ab/c/',
+            'ab/c/d', 'b', 'b/', 'b/c', 'c', 'cd', '/', '/x', 'd/e/f',
+            'd/e/fg/h', 'd/e', '*']
+        for i in range(len(patterns)):
+            subset = patterns[i:] + patterns[:i // 2]
+            matcher = SubpathMatcher(subset)
+            for subpath in subpaths:
+                self.assertEqual(matcher.match(subpath),
+                    linear(subset, subpath), (subset, subpath))
+
+    def test_0100_validate_type_subpath_mapping(self):
+        sm = ContentTypeScopeManager()
+        mapping = {'Folder': ['folder_contents', 'edit/*', 'test_*'],
+            'Document': []}
+        self.assertTrue(sm.validateTypeSubpathMapping(
+            'Folder', 'folder_contents', mapping))
+        # without a slash the asterisk is matched as is.
+        self.assertTrue(sm.validateTypeSubpathMapping(
+            'Folder', 'test_*', mapping))
+        self.assertFalse(sm.validateTypeSubpathMapping(
+            'Folder', 'test_x', mapping))
+        self.assertTrue(sm.validateTypeSubpathMapping(
+            'Folder', 'edit/x', mapping))
+        self.assertFalse(sm.validateTypeSubpathMapping(
+            'Folder', 'view', mapping))
+        self.assertFalse(sm.validateTypeSubpathMapping(
+            'Document', 'view', mapping))
+        self.assertFalse(sm.validateTypeSubpathMapping(
+            None, None, mapping))
+
+        # not cached, the modifications are seen.
+        mapping['Folder'].append('view')
+        self.assertTrue(sm.validateTypeSubpathMapping(
+            'Folder', 'view', mapping))
+
+    def test_0200_effective_scope(self):
+        sm = ContentTypeScopeManager()
+        m1 = sm.addMapping({'Folder': ['folder_contents']})
+        m2 = sm.addMapping({'Folder': ['edit/*'], 'Document': ['view']},
+            methods='POST')
+        scope = sm.getEffectiveScope([m1, m2])
+        self.assertEqual(scope.methods, set(['GET', 'HEAD', 'OPTIONS',
+            'POST']))
+        self.assertTrue(scope.match('Folder', 'GET', 'folder_contents'))
+        self.assertFalse(scope.match('Folder', 'GET', 'edit/x'))
+        self.assertTrue(scope.match('Folder', 'POST', 'edit/x'))
+        self.assertFalse(scope.match('Folder', 'POST', 'folder_contents'))
+        self.assertTrue(scope.match('Document', 'POST', 'view'))
+        self.assertFalse(scope.match('Document', 'GET', 'view'))
+
+        # cached regardless of the order of the ids.
+        self.assertTrue(scope is sm.getEffectiveScope([m2, m1]))
+        self.assertFalse(scope is sm.getEffectiveScope([m1]))
+
+    def test_0201_effective_scope_invalidated(self):
+        sm = ContentTypeScopeManager()
+        m1 = sm.addMapping({'Folder': ['folder_contents']})
+        scope = sm.getEffectiveScope([m1])
+
+        # any added mapping will have the scopes built again.
+        sm._mappings[m1] = {'Folder': ['view']}
+        self.assertTrue(scope is sm.getEffectiveScope([m1]))
+        sm.addMapping({})
+        scope = sm.getEffectiveScope([m1])
+        self.assertFalse(scope.match('Folder', 'GET', 'folder_contents'))
+        self.assertTrue(scope.match('Folder', 'GET', 'view'))
+
+        sm._methods[m1] = ['POST']
+        sm.addMapping({})
+        scope = sm.getEffectiveScope([m1])
+        self.assertFalse(scope.match('Folder', 'GET', 'view'))
+        self.assertTrue(scope.match('Folder', 'POST', 'view'))
+
+    def test_0202_effective_scope_bounded(self):
+        sm = ContentTypeScopeManager()
+        sm.effective_scope_cache_size = 2
+        ids = [sm.addMapping({'Folder': ['view']}) for i in range(3)]
+        for i in ids:
+            sm.getEffectiveScope([i])
+        self.assertEqual(len(sm._v_effective_scopes), 2)
+
+    def test_0203_effective_scope_no_lookups(self):
+        sm = ContentTypeScopeManager()
+        m1 = sm.addMapping({'Folder': ['folder_contents']})
+        scope = sm.getEffectiveScope([m1, 99])
+        self.assertTrue(scope.match('Folder', 'GET', 'folder_contents'))
+
+        lookups = []
+        def getMapping(mapping_id, default=None):
+            lookups.append(mapping_id)
+            return default
+        sm.getMapping = getMapping
+        # including the missing mapping.
+        self.assertTrue(scope is sm.getEffectiveScope([m1, 99]))
+        self.assertTrue(sm.getEffectiveScope([99]) is
+            sm.getEffectiveScope([99]))
+        self.assertEqual(lookups, [99])
+
+
+class DummyTypeInfo(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class DummyTypesTool(SimpleItem):
+
+    def __init__(self):
+        self.calls = 0
+
+    def getTypeInfo(self, context):
+        self.calls += 1
+        portal_type = getattr(aq_base(context), 'portal_type', None)
+        return portal_type and DummyTypeInfo(portal_type) or None
+
+
+class CTSMResolveTargetTestCase(unittest.TestCase):
+    """
+    Testing the caching of the resolved targets.
+    """
+
+    def setUp(self):
+        resolved_targets.clear()
+        moved_paths.clear()
+        self.sm = ContentTypeScopeManager()
+        self.root = Folder('root')
+        self.root.portal_types = DummyTypesTool()
+        self.root._setObject('site', Folder('site'))
+        site = self.root.site
+        site.portal_type = 'Plone Site'
+        site._setObject('a', Folder('a'))
+        site.a._setObject('b', Folder('b'))
+        self.pt = self.root.portal_types
+
+    def tearDown(self):
+        resolved_targets.clear()
+        moved_paths.clear()
+
+    def test_0000_cached(self):
+        b = self.root.site.a.b
+        self.assertEqual(self.sm.resolveTarget(b, 'view'),
+            ('Plone Site', 'a/b/view'))
+        calls = self.pt.calls
+        self.assertEqual(self.sm.resolveTarget(b, 'view'),
+            ('Plone Site', 'a/b/view'))
+        self.assertEqual(self.pt.calls, calls)
+        self.assertEqual(self.sm.resolveTarget(b, 'edit'),
+            ('Plone Site', 'a/b/edit'))
+        self.assertNotEqual(self.pt.calls, calls)
+
+    def test_0001_invalidated_on_move(self):
+        site = self.root.site
+        self.sm.resolveTarget(site.a.b, 'view')
+        self.sm.resolveTarget(site, 'view')
+        self.assertEqual(len(resolved_targets), 2)
+
+        invalidateResolvedTargets(ObjectMovedEvent(site.a, site, 'a',
+            site, 'c'))
+        self.assertEqual(len(moved_paths), 2)
+
+        # only the target at or beneath the moved object is stale.
+        calls = self.pt.calls
+        self.assertEqual(self.sm.resolveTarget(site, 'view'),
+            ('Plone Site', 'view'))
+        self.assertEqual(self.pt.calls, calls)
+
+        site.a.portal_type = 'Folder'
+        self.assertEqual(self.sm.resolveTarget(site.a.b, 'view'),
+            ('Folder', 'b/view'))
+        # resolved after the move, so cached again.
+        calls = self.pt.calls
+        self.assertEqual(self.sm.resolveTarget(site.a.b, 'view'),
+            ('Folder', 'b/view'))
+        self.assertEqual(self.pt.calls, calls)
+
+    def test_0002_expired(self):
+        b = self.root.site.a.b
+        timer = resolved_targets._timer
+        resolved_targets._timer = lambda: 0
+        try:
+            self.sm.resolveTarget(b, 'view')
+            # e.g. moved by another process.
+            b.portal_type = 'Folder'
+            self.assertEqual(self.sm.resolveTarget(b, 'view'),
+                ('Plone Site', 'a/b/view'))
+            resolved_targets._timer = lambda: resolved_targets.ttl
+            self.assertEqual(self.sm.resolveTarget(b, 'view'),
+                ('Folder', 'view'))
+        finally:
+            resolved_targets._timer = timer
+
+    def test_0003_moved_paths_full(self):
+        site = self.root.site
+        self.sm.resolveTarget(site, 'view')
+        moved_paths.maxsize = 1
+        try:
+            invalidateResolvedTargets(ObjectMovedEvent(site.a, site, 'a',
+                None, None))
+            self.assertEqual(len(resolved_targets), 1)
+            invalidateResolvedTargets(ObjectMovedEvent(site.a, site, 'a',
+                None, None))
+            self.assertEqual(len(resolved_targets), 0)
+        finally:
+            moved_paths.maxsize = 10000
+
+    def test_0004_not_cached_without_path(self):
+        self.assertEqual(self.sm.resolveTarget(object(), 'view'),
+            (None, None))
+        self.assertEqual(len(resolved_targets), 0)
+
+
 class CTSMPloneIntegrationTestCase(ptc.PloneTestCase):
     """
     Testing the validation on just the objects with the provided 
@@ -335,6 +610,8 @@ def test_suite():
     suite.addTest(makeSuite(BTreeScopeManagerTestCase))
     suite.addTest(makeSuite(CTSMMappingTestCase))
     suite.addTest(makeSuite(CTSMEditingTestCase))
+    suite.addTest(makeSuite(CTSMMatcherTestCase))
+    suite.addTest(makeSuite(CTSMResolveTargetTestCase))
     suite.addTest(makeSuite(CTSMPloneIntegrationTestCase))
     suite.addTest(makeSuite(CTSMValidateTestCase))
     return suite
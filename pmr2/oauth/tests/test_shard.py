@@ -0,0 +1,67 @@
+import unittest
+
+from BTrees.OOBTree import OOBTree
+
+from pmr2.oauth.shard import ShardedOOBTree, shardOf
+
+
+class ShardedOOBTreeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = ShardedOOBTree(4)
+        self.keys = ['key-%02d' % i for i in range(20)]
+        for key in self.keys:
+            self.tree[key] = key.upper()
+
+    def test_0000_shard_of(self):
+        self.assertEqual(shardOf('key', 16), shardOf('key', 16))
+        self.assertEqual(shardOf(u'key', 16), shardOf('key', 16))
+        self.assertTrue(0 <= shardOf(None, 16) < 16)
+        # the keys are spread over the trees.
+        self.assertTrue(min([len(s) for s in self.tree._shards]) > 0)
+
+    def test_0001_mapping(self):
+        self.assertEqual(len(self.tree), 20)
+        self.assertTrue(self.tree)
+        self.assertEqual(self.tree['key-01'], 'KEY-01')
+        self.assertEqual(self.tree.get('key-01'), 'KEY-01')
+        self.assertEqual(self.tree.get('missing'), None)
+        self.assertRaises(KeyError, self.tree.__getitem__, 'missing')
+        self.assertTrue('key-02' in self.tree)
+        self.assertFalse('missing' in self.tree)
+
+        del self.tree['key-02']
+        self.assertFalse('key-02' in self.tree)
+        self.assertEqual(self.tree.pop('key-03'), 'KEY-03')
+        self.assertEqual(self.tree.pop('key-03', None), None)
+        self.assertRaises(KeyError, self.tree.pop, 'key-03')
+        self.assertFalse(self.tree.insert('key-04', 'other'))
+        self.assertEqual(self.tree['key-04'], 'KEY-04')
+        self.assertEqual(len(self.tree), 18)
+        self.assertFalse(ShardedOOBTree(4))
+
+    def test_0002_ordered(self):
+        self.assertEqual(list(self.tree.keys()), self.keys)
+        self.assertEqual(list(self.tree), self.keys)
+        self.assertEqual(list(self.tree.values()),
+            [k.upper() for k in self.keys])
+        self.assertEqual(list(self.tree.items())[0], ('key-00', 'KEY-00'))
+        self.assertEqual(list(self.tree.keys(min='key-17',
+            excludemin=True)), ['key-18', 'key-19'])
+        self.assertEqual(list(self.tree.keys(max='key-01')),
+            ['key-00', 'key-01'])
+
+    def test_0003_update(self):
+        tree = OOBTree()
+        tree['a'] = 1
+        tree['b'] = 2
+        sharded = ShardedOOBTree(2)
+        sharded.update(tree)
+        self.assertEqual(list(sharded.items()), [('a', 1), ('b', 2)])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(ShardedOOBTreeTestCase))
+    return suite
@@ -1,6 +1,7 @@
 import time
 import unittest
 
+import transaction
 import zope.component
 
 from pmr2.oauth.consumer import ConsumerManager
@@ -8,6 +9,8 @@ from pmr2.oauth.consumer import Consumer
 
 from pmr2.oauth.token import TokenManager
 from pmr2.oauth.token import Token
+from pmr2.oauth.token import TokenRecord
+from pmr2.oauth.token import token_usage
 
 from pmr2.oauth.interfaces import *
 
@@ -71,6 +74,28 @@ class TestConsumer(unittest.TestCase):
         m.remove(c2)
         self.assertEqual(len(m._consumers), 0)
 
+    def test_104_consumer_manager_page(self):
+        m = ConsumerManager()
+        self.assertEqual(m.getConsumerPage(), ([], None))
+        for i in range(5):
+            m.add(Consumer('consumer-%d' % i, 'consumer-secret'))
+
+        consumers, start = m.getConsumerPage(batch_size=2)
+        self.assertEqual([c.key for c in consumers],
+            ['consumer-0', 'consumer-1'])
+        self.assertEqual(start, 'consumer-1')
+        consumers, start = m.getConsumerPage(start, 2)
+        self.assertEqual([c.key for c in consumers],
+            ['consumer-2', 'consumer-3'])
+        consumers, start = m.getConsumerPage(start, 2)
+        self.assertEqual([c.key for c in consumers], ['consumer-4'])
+        self.assertEqual(start, None)
+
+        # exact fit does not point to an empty page.
+        consumers, start = m.getConsumerPage(batch_size=5)
+        self.assertEqual(len(consumers), 5)
+        self.assertEqual(start, None)
+
 
 class TestToken(unittest.TestCase):
 
@@ -206,6 +231,22 @@ class TestToken(unittest.TestCase):
         # User must know about the token for the getter to work.
         self.assertEqual(m.getTokensForUser('t2user'), [])
 
+    def test_116_token_manager_user_many_tokens(self):
+        m = TokenManager()
+        tokens = []
+        for i in range(10):
+            token = Token('token-key%d' % i, 'token-secret')
+            token.user = 'user'
+            token.access = True
+            m.add(token)
+            tokens.append(token)
+        self.assertTrue(m.hasTokensForUser('user'))
+        self.assertEqual(m.getAccessToken('token-key5'), tokens[5])
+        for token in tokens:
+            m.remove(token)
+        self.assertFalse(m.hasTokensForUser('user'))
+        self.assertEqual(m.getTokensForUser('user'), [])
+
     def test_120_token_manager_access_token_tm_empty(self):
         m = TokenManager()
         self.assertRaises(TokenInvalidError, m.getAccessToken, 'token-key')
@@ -340,6 +381,263 @@ class TestToken(unittest.TestCase):
         self.assertRaises(TokenInvalidError, m.generateAccessToken, 
             consumer.key, None)
 
+    def test_400_token_manager_purge_expired(self):
+        m = TokenManager()
+        consumer = Consumer('consumer-key', 'consumer-secret')
+        now = int(time.time())
+        old = m.generateRequestToken(consumer.key, 'oob')
+        # reindex with the hacked expiry.
+        m._del_expiry_index(old.key, old.expiry)
+        old.expiry = now - 1000
+        m._add_expiry_index(old)
+        fresh = m.generateRequestToken(consumer.key, 'oob')
+
+        removed = m.purgeExpiredTokens(now)
+        self.assertEqual(removed, [old.key])
+        self.assertEqual(m.get(old.key), None)
+        self.assertEqual(m.get(fresh.key), fresh)
+        # dummy token is not affected.
+        self.assertNotEqual(m.get(m.DUMMY_KEY), None)
+
+        # fresh one is purged once it expired.
+        removed = m.purgeExpiredTokens(fresh.expiry + 1)
+        self.assertEqual(removed, [fresh.key])
+        self.assertEqual(len(m._expiry_index), 0)
+
+    def test_401_token_manager_purge_expired_limit(self):
+        m = TokenManager()
+        consumer = Consumer('consumer-key', 'consumer-secret')
+        tokens = [m.generateRequestToken(consumer.key, 'oob')
+            for i in range(5)]
+        future = int(time.time()) + m.claim_timeout + 1
+        removed = m.purgeExpiredTokens(future, limit=3)
+        self.assertEqual(len(removed), 3)
+        removed = m.purgeExpiredTokens(future, limit=3)
+        self.assertEqual(len(removed), 2)
+        self.assertEqual(m.purgeExpiredTokens(future), [])
+        self.assertEqual(len(m._tokens), 1)
+
+    def test_402_token_manager_purge_expired_claimed(self):
+        m = TokenManager()
+        consumer = Consumer('consumer-key', 'consumer-secret')
+        token = m.generateRequestToken(consumer.key, 'oob')
+        token.expiry = int(time.time()) - 1000
+        m.claimRequestToken(token, 'user')
+        # claiming extended the expiry.
+        self.assertEqual(m.purgeExpiredTokens(), [])
+        self.assertEqual(m.get(token.key), token)
+
+    def test_403_token_manager_purge_expired_keep_access(self):
+        m = TokenManager()
+        consumer = Consumer('consumer-key', 'consumer-secret')
+        server_token = m.generateRequestToken(consumer.key, 'oob')
+        m.claimRequestToken(server_token.key, 'user')
+        token = m.generateAccessToken(consumer.key, server_token.key)
+        future = int(time.time()) + m.claim_timeout + 1
+        self.assertEqual(m.purgeExpiredTokens(future), [server_token.key])
+        self.assertEqual(m.getAccessToken(token.key), token)
+
+    def _accessToken(self, m, consumer_key, user):
+        token = m.generateRequestToken(consumer_key, 'oob')
+        m.claimRequestToken(token.key, user)
+        return m.generateAccessToken(consumer_key, token.key)
+
+    def test_404_token_manager_revoke_consumer(self):
+        m = TokenManager()
+        t1 = self._accessToken(m, 'consumer1', 'user1')
+        t2 = self._accessToken(m, 'consumer1', 'user2')
+        t3 = self._accessToken(m, 'consumer2', 'user1')
+        pending = m.generateRequestToken('consumer1', 'oob')
+        # only the access tokens are revoked, the request tokens are
+        # left to expire.
+        self.assertEqual(len(m.revokeTokensForConsumer('consumer1')), 2)
+        self.assertEqual(m.get(t1.key), None)
+        self.assertEqual(m.get(t2.key), None)
+        self.assertEqual(m.getTokensForUser('user1'), [t3])
+        self.assertEqual(m.revokeTokensForConsumer('consumer1'), [])
+        self.assertFalse('consumer1' in m._consumer_token_map)
+        self.assertEqual(m.get(pending.key), pending)
+        self.assertNotEqual(m.get(m.DUMMY_KEY), None)
+
+    def test_405_token_manager_revoke_user(self):
+        m = TokenManager()
+        tokens = [self._accessToken(m, 'consumer', 'user1')
+            for i in range(3)]
+        t2 = self._accessToken(m, 'consumer', 'user2')
+        self.assertEqual(len(m.revokeTokensForUser('user1', limit=2)), 2)
+        self.assertEqual(len(m.revokeTokensForUser('user1', limit=2)), 1)
+        self.assertEqual(m.getTokensForUser('user1'), [])
+        self.assertEqual(m.getAccessToken(t2.key), t2)
+
+    def test_406_token_manager_revoke_before(self):
+        m = TokenManager()
+        old = [self._accessToken(m, 'consumer', 'user') for i in range(3)]
+        for token in old:
+            m._del_timestamp_index(token)
+            token.timestamp = 1000
+            m._add_timestamp_index(token)
+        fresh = self._accessToken(m, 'consumer', 'user')
+        self.assertEqual(len(m.revokeTokensBefore(2000, limit=2)), 2)
+        self.assertEqual(len(m.revokeTokensBefore(2000)), 1)
+        self.assertEqual(m.revokeTokensBefore(2000), [])
+        self.assertEqual(m.getTokensForUser('user'), [fresh])
+
+    def test_407_token_manager_remove_tokens(self):
+        m = TokenManager()
+        token = self._accessToken(m, 'consumer', 'user')
+        self.assertEqual(
+            m.removeTokens([token.key, 'missing', m.DUMMY_KEY]),
+            [token.key])
+        self.assertNotEqual(m.get(m.DUMMY_KEY), None)
+        self.assertEqual(len(m._timestamp_index), 0)
+
+    def test_408_token_manager_consumer_tokens(self):
+        m = TokenManager()
+        self.assertEqual(m.countTokensForConsumer('consumer1'), 0)
+        t1 = self._accessToken(m, 'consumer1', 'user1')
+        t2 = self._accessToken(m, 'consumer1', 'user2')
+        t3 = self._accessToken(m, 'consumer2', 'user1')
+        # pending request tokens are not counted.
+        m.generateRequestToken('consumer1', 'oob')
+        self.assertEqual(m.countTokensForConsumer('consumer1'), 2)
+        self.assertEqual(m.countTokensForConsumer('consumer2'), 1)
+        self.assertEqual(
+            sorted([t.key for t in m.getTokensForConsumer('consumer1')]),
+            sorted([t1.key, t2.key]))
+        m.remove(t1)
+        self.assertEqual(m.countTokensForConsumer('consumer1'), 1)
+        self.assertEqual(m.getTokensForConsumer('consumer2'), [t3])
+        m.revokeTokensForConsumer('consumer2')
+        self.assertEqual(m.countTokensForConsumer('consumer2'), 0)
+        self.assertFalse('consumer2' in m._consumer_access_count)
+
+    def test_409_token_manager_user_token_page(self):
+        m = TokenManager()
+        self.assertEqual(m.getTokenPageForUser('user'), ([], None))
+        tokens = [self._accessToken(m, 'consumer%d' % i, 'user')
+            for i in range(3)]
+        keys = sorted([t.key for t in tokens])
+
+        summaries, start = m.getTokenPageForUser('user', batch_size=2)
+        self.assertEqual([s['key'] for s in summaries], keys[:2])
+        self.assertEqual(start, keys[1])
+        token = m.get(keys[0])
+        self.assertEqual(summaries[0], {
+            'key': token.key,
+            'consumer_key': token.consumer_key,
+            'timestamp': token.timestamp,
+        })
+
+        summaries, start = m.getTokenPageForUser('user', start, 2)
+        self.assertEqual([s['key'] for s in summaries], keys[2:])
+        self.assertEqual(start, None)
+
+        m.remove(keys[0])
+        summaries, start = m.getTokenPageForUser('user')
+        self.assertEqual([s['key'] for s in summaries], keys[1:])
+
+    def test_410_token_manager_idle_tokens(self):
+        m = TokenManager()
+        tokens = [self._accessToken(m, 'consumer', 'user')
+            for i in range(3)]
+        for token in tokens:
+            m._del_timestamp_index(token)
+            token.timestamp = 1000
+            m._add_timestamp_index(token)
+        fresh = self._accessToken(m, 'consumer', 'user')
+
+        self.assertEqual(m.getLastUsed(tokens[0].key), None)
+        m.recordUsage(tokens[0].key, 3000)
+        self.assertEqual(m.getLastUsed(tokens[0].key), 3000)
+        m.recordUsage(tokens[0].key, 2500)
+        self.assertEqual(m.getLastUsed(tokens[0].key), 3000)
+
+        self.assertEqual(sorted(m.getIdleTokens(2000)),
+            sorted([tokens[1].key, tokens[2].key]))
+        self.assertEqual(len(m.getIdleTokens(2000, limit=1)), 1)
+        self.assertEqual(len(m.revokeIdleTokens(2000)), 2)
+        self.assertEqual(m.revokeIdleTokens(4000), [tokens[0].key])
+        self.assertFalse(tokens[0].key in m._last_used)
+        self.assertEqual(m.getTokensForUser('user'), [fresh])
+
+    def test_411_token_manager_separate_trees(self):
+        m = TokenManager()
+        request = m.generateRequestToken('consumer', 'oob')
+        m.claimRequestToken(request.key, 'user')
+        access = m.generateAccessToken('consumer', request.key)
+        self.assertEqual(list(m._request_tokens.keys()), [request.key])
+        self.assertFalse(request.key in m._tokens)
+        self.assertTrue(access.key in m._tokens)
+
+        self.assertEqual(m.get(request.key), request)
+        self.assertEqual(m.get(access.key), access)
+        self.assertEqual(m.getRequestToken(request.key), request)
+        self.assertEqual(m.getAccessToken(access.key), access)
+        self.assertRaises(NotRequestTokenError, m.getRequestToken, access.key)
+        self.assertRaises(NotAccessTokenError, m.getAccessToken, request.key)
+        self.assertEqual(m.getAccessToken(request.key, None), None)
+        self.assertRaises(TokenInvalidError, m.getRequestToken, 'missing')
+
+        m.remove(request.key)
+        self.assertEqual(len(m._request_tokens), 0)
+        self.assertEqual(m.get(access.key), access)
+
+    def test_412_maintenance_batches_checked(self):
+        from pmr2.oauth import maintenance
+        # rejected before anything is looked up.
+        for f, kw in (
+                (maintenance.purgeExpiredTokens, {}),
+                (maintenance.revokeTokens, {'user': 'user'}),
+                (maintenance.compactTokens, {}),
+                ):
+            self.assertRaises(ValueError, f, None, None, batch_size=0, **kw)
+            self.assertRaises(ValueError, f, None, None, batch_size=-1, **kw)
+            self.assertRaises(ValueError, f, None, None, max_batches=-1,
+                **kw)
+
+    def test_413_token_manager_before_upgrade(self):
+        from persistent.list import PersistentList
+        m = TokenManager()
+        # as stored by the earlier versions, with the tokens in a single
+        # tree and the keys of the tokens of each user in a list.
+        for name in TokenManager._added_trees:
+            delattr(m, name)
+        old = Token('old-key', 'old-secret')
+        old.consumer_key = 'consumer'
+        old.user = 'user'
+        old.access = True
+        m._tokens[old.key] = old
+        m._user_token_map['user'] = PersistentList([old.key])
+
+        self.assertEqual(m.get('missing'), None)
+        self.assertEqual(m.getAccessToken(old.key), old)
+        token = m.generateRequestToken('consumer', 'oob')
+        m.claimRequestToken(token.key, 'user')
+        access = m.generateAccessToken('consumer', token.key)
+        m.remove(token.key)
+        self.assertEqual(m.getAccessToken(access.key), access)
+        self.assertEqual(sorted(m.getTokensForUser('user')),
+            sorted([old, access]))
+        self.assertEqual(len(m.getTokenPageForUser('user')[0]), 2)
+        m.recordUsage(access.key, 1000)
+        self.assertEqual(m.purgeExpiredTokens(), [])
+        m.remove(old)
+        self.assertEqual(m.getTokensForUser('user'), [access])
+
+    def test_414_token_manager_consumer_index_stale(self):
+        m = TokenManager()
+        token = m.generateRequestToken('consumer', 'oob')
+        self.assertFalse('consumer' in m._consumer_token_map)
+        m.claimRequestToken(token.key, 'user')
+        access = m.generateAccessToken('consumer', token.key)
+        m.remove(token.key)
+        self.assertEqual(list(m._consumer_token_map['consumer']),
+            [access.key])
+        # a key left behind in the index, like by a token removed from
+        # the tree directly, is skipped.
+        m._consumer_token_map['consumer'].insert('removed')
+        self.assertEqual(m.getTokensForConsumer('consumer'), [access])
+
     def test_500_token_manager_get_dummy(self):
         m = TokenManager()
         token = m.get(m.DUMMY_KEY)
@@ -354,9 +652,158 @@ class TestToken(unittest.TestCase):
         self.assertEqual(token, None)
 
 
+class TestTokenRecord(unittest.TestCase):
+
+    def test_000_record(self):
+        token = Token('key', 'secret')
+        token.set_callback('http://example.com/cb')
+        token.set_verifier('verifier')
+        token.timestamp = 1000
+        record = TokenRecord.fromToken(token)
+        self.assertTrue(IToken.providedBy(record))
+        self.assertEqual(record.key, 'key')
+        self.assertEqual(record.secret, 'secret')
+        self.assertEqual(record.access, False)
+        self.assertEqual(record.user, None)
+        self.assertEqual(record.timestamp, 1000)
+        self.assertEqual(record.get_callback_url(), token.get_callback_url())
+        self.assertRaises(AttributeError, setattr, record, 'user', 'user')
+
+        claimed = record._replace(user='user', expiry=2000)
+        self.assertEqual(claimed.user, 'user')
+        self.assertEqual(claimed.expiry, 2000)
+        self.assertEqual(record.user, None)
+
+    def test_001_pickle(self):
+        import cPickle
+        record = TokenRecord('key', 'secret', access=True, user='user')
+        result = cPickle.loads(cPickle.dumps(record, 1))
+        self.assertTrue(isinstance(result, TokenRecord))
+        self.assertEqual(result, record)
+
+    def test_100_manager_compact(self):
+        m = TokenManager()
+        self.assertEqual(m.compactTokens(), None)
+        self.assertTrue(m.compact)
+
+        token = m.generateRequestToken('consumer', 'oob')
+        self.assertTrue(isinstance(token, TokenRecord))
+        m.claimRequestToken(token.key, 'user')
+        self.assertEqual(m.getRequestToken(token.key).user, 'user')
+        self.assertTrue(m.requestTokenVerify('consumer', token.key,
+            token.verifier))
+        access = m.generateAccessToken('consumer', token.key)
+        self.assertTrue(isinstance(access, TokenRecord))
+        self.assertEqual(m.getAccessToken(access.key), access)
+        self.assertEqual(m.getTokensForUser('user'), [access])
+        self.assertEqual(m.revokeTokensForUser('user'), [access.key])
+
+    def test_101_manager_compact_existing(self):
+        m = TokenManager()
+        tokens = [m.generateRequestToken('consumer', 'oob')
+            for i in range(3)]
+        keys = sorted([t.key for t in tokens])
+
+        start = m.compactTokens(limit=2)
+        self.assertEqual(start, keys[1])
+        self.assertEqual(
+            [isinstance(m.get(k), TokenRecord) for k in keys],
+            [True, True, False])
+        # the dummy is in the access token tree.
+        self.assertTrue(isinstance(m.get(m.DUMMY_KEY), TokenRecord))
+        self.assertEqual(m.compactTokens(start, 2), None)
+        self.assertEqual(
+            [isinstance(m.get(k), TokenRecord) for k in keys],
+            [True, True, True])
+        self.assertEqual(m.get(m.DUMMY_KEY).secret, m.DUMMY_SECRET)
+
+    def test_200_persisted(self):
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        db = DB(MappingStorage())
+        try:
+            conn = db.open()
+            m = TokenManager()
+            m.compactTokens()
+            conn.root()['tokens'] = m
+            token = m.generateRequestToken('consumer', 'oob')
+            transaction.commit()
+
+            other = db.open(
+                transaction_manager=transaction.TransactionManager())
+            result = other.root()['tokens'].get(token.key)
+            self.assertTrue(isinstance(result, TokenRecord))
+            self.assertEqual(result, token)
+            other.close()
+            conn.close()
+        finally:
+            transaction.abort()
+            db.close()
+
+
+class TestTokenUsage(unittest.TestCase):
+
+    def setUp(self):
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        self.db = DB(MappingStorage())
+        self.conn = self.db.open()
+        self.m = TokenManager()
+        self.conn.root()['tokens'] = self.m
+        transaction.commit()
+        token_usage.clear()
+
+    def tearDown(self):
+        transaction.abort()
+        token_usage.clear()
+        self.conn.close()
+        self.db.close()
+
+    def test_000_buffered(self):
+        self.m.recordUsage('key', 1000)
+        # not written into the tree, nor the transaction of the request.
+        self.assertEqual(self.m._last_used.get('key'), None)
+        self.assertFalse(self.conn._registered_objects)
+        self.assertEqual(self.m.getLastUsed('key'), 1000)
+
+        self.assertEqual(token_usage.flush(), 1)
+        self.assertEqual(token_usage.get(self.m._last_used, 'key'), None)
+        transaction.abort()
+        self.conn.sync()
+        self.assertEqual(self.m._last_used.get('key'), 1000)
+        self.assertEqual(self.m.getLastUsed('key'), 1000)
+
+    def test_001_flush_on_interval(self):
+        self.m.recordUsage('key', 1000)
+        token_usage._last_flush = 0
+        self.m.recordUsage('key2', 1000)
+        transaction.abort()
+        self.conn.sync()
+        self.assertEqual(sorted(self.m._last_used.keys()), ['key', 'key2'])
+
+    def test_002_flush_failure_kept(self):
+        self.m.recordUsage('key', 1000)
+        # a tree that is gone (POSKeyError) rather than a conflict.
+        missing = (self.db, '\0' * 7 + '\xff')
+        token_usage._pending[missing] = {'key': 1000}
+        self.assertEqual(token_usage.flush(), 1)
+        self.assertEqual(token_usage._pending, {missing: {'key': 1000}})
+
+        # the storage is gone, the flush done by the request is quiet.
+        self.m.recordUsage('key', 1001)
+        self.db.close()
+        token_usage._last_flush = 0
+        self.m.recordUsage('key2', 1002)
+        self.assertEqual(token_usage.get(self.m._last_used, 'key'), 1001)
+        self.assertEqual(token_usage.get(self.m._last_used, 'key2'), 1002)
+        self.assertEqual(token_usage._pending[missing], {'key': 1000})
+
+
 def test_suite():
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
     suite.addTest(makeSuite(TestConsumer))
     suite.addTest(makeSuite(TestToken))
+    suite.addTest(makeSuite(TestTokenRecord))
+    suite.addTest(makeSuite(TestTokenUsage))
     return suite
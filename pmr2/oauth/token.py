@@ -1,9 +1,17 @@
+import json
 import time
+import threading
 import urlparse
+from logging import getLogger
+from operator import itemgetter
+
+import transaction
+from ZODB.POSException import ConflictError
 
 from persistent import Persistent
-from persistent.list import PersistentList
-from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
 
 from zope.container.contained import Contained
 from zope.annotation.interfaces import IAttributeAnnotatable
@@ -13,11 +21,142 @@ from zope.schema import fieldproperty
 
 from pmr2.oauth.interfaces import IToken
 from pmr2.oauth.interfaces import ITokenManager
+from pmr2.oauth.interfaces import IKeyValueStore, IKeyValueStoreLayer
 from pmr2.oauth.interfaces import CallbackValueError
 from pmr2.oauth.interfaces import TokenInvalidError, ExpiredTokenError
 from pmr2.oauth.interfaces import NotAccessTokenError, NotRequestTokenError
 from pmr2.oauth.factory import factory
-from pmr2.oauth.utility import random_string
+from pmr2.oauth.utility import random_string, forgetUnknownKey
+from pmr2.oauth.utility import forgetHMACContext
+from pmr2.oauth.backend import storeKey
+from pmr2.oauth.shard import ShardedOOBTree
+
+logger = getLogger('pmr2.oauth.token')
+
+
+class UsageBuffer(object):
+    """\
+    Buffer of the times the access tokens were last used, kept by the
+    process and flushed into the usage trees of the token managers at
+    most once every flush_interval seconds.
+
+    The flush is done in a single transaction through a connection of
+    its own, such that neither the requests using the tokens nor the
+    tokens themselves are written to.
+    """
+
+    flush_interval = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.time()
+
+    def record(self, tree, key, timestamp):
+        jar = tree._p_jar
+        if jar is None or tree._p_oid is None:
+            # not persisted yet, nothing to coalesce the writes for.
+            if tree.get(key, 0) < timestamp:
+                tree[key] = timestamp
+            return
+
+        self._lock.acquire()
+        try:
+            usage = self._pending.setdefault((jar.db(), tree._p_oid), {})
+            usage[key] = max(usage.get(key, 0), timestamp)
+            due = time.time() - self._last_flush >= self.flush_interval
+        finally:
+            self._lock.release()
+
+        if due:
+            self.flush()
+
+    def get(self, tree, key):
+        jar = tree._p_jar
+        if jar is None or tree._p_oid is None:
+            return None
+        self._lock.acquire()
+        try:
+            usage = self._pending.get((jar.db(), tree._p_oid), {})
+            return usage.get(key)
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """\
+        Write the buffered times into their trees, returning the number
+        of entries written.  The entries of a failed write are put back
+        into the buffer for the next flush.
+
+        As this is done within the request that happened to be due for
+        the flush, the errors are logged rather than raised.
+        """
+
+        self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        finally:
+            self._lock.release()
+
+        written = 0
+        for (db, oid), usage in pending.items():
+            tm = transaction.TransactionManager()
+            conn = None
+            try:
+                try:
+                    conn = db.open(transaction_manager=tm)
+                    tree = conn.get(oid)
+                    for key, timestamp in usage.items():
+                        if tree.get(key, 0) < timestamp:
+                            tree[key] = timestamp
+                    tm.commit()
+                    written += len(usage)
+                except ConflictError:
+                    logger.info('conflict writing the token usage, '
+                        'will retry on the next flush')
+                    self._restore(db, oid, usage)
+                    self._abort(tm)
+                except Exception:
+                    logger.exception('failed to write the token usage, '
+                        'will retry on the next flush')
+                    self._restore(db, oid, usage)
+                    self._abort(tm)
+            finally:
+                if conn is not None:
+                    self._close(conn)
+        return written
+
+    def _abort(self, tm):
+        try:
+            tm.abort()
+        except Exception:
+            logger.exception('failed to abort the token usage transaction')
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            logger.exception('failed to close the token usage connection')
+
+    def _restore(self, db, oid, usage):
+        self._lock.acquire()
+        try:
+            pending = self._pending.setdefault((db, oid), {})
+            for key, timestamp in usage.items():
+                pending[key] = max(pending.get(key, 0), timestamp)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._pending = {}
+        finally:
+            self._lock.release()
+
+
+token_usage = UsageBuffer()
 
 
 class TokenManager(Persistent, Contained):
@@ -37,49 +176,215 @@ class TokenManager(Persistent, Contained):
 
     # expiry
     claim_timeout = 180
+
+    # granularity (in seconds) of the buckets within the expiry index.
+    expiry_bucket_size = 60
+
+    # whether the tokens are stored as TokenRecords, set by compactTokens.
+    compact = False
+
+    # number of trees the tokens are spread over, see ShardedOOBTree.
+    shard_count = 16
     
     def __init__(self):
-        self._tokens = OOBTree()
+        # the access tokens, with the short lived request tokens kept in
+        # a tree of their own such that their churn does not touch the
+        # buckets holding the access tokens.
+        self._tokens = ShardedOOBTree(self.shard_count)
+        self._request_tokens = ShardedOOBTree(self.shard_count)
         self._user_token_map = OOBTree()
+        # bucketed expiry time to the set of request token keys.
+        self._expiry_index = IOBTree()
+        # consumer key to the set of token keys issued to it.
+        self._consumer_token_map = OOBTree()
+        # consumer key to the number of access tokens issued to it.
+        self._consumer_access_count = OOBTree()
+        # bucketed creation time to the set of access token keys.
+        self._timestamp_index = IOBTree()
+        # access token key to the time it was last used, written to by
+        # the usage buffer only.
+        self._last_used = OOBTree()
         dummy = self._makeDummy()
         self.add(dummy)
 
+    # The trees added in 0.7, created as they are first needed by the
+    # managers stored before then, such that these keep working until
+    # the upgrade step fills in the indexes.
+    _added_trees = {
+        '_request_tokens': lambda self: ShardedOOBTree(self.shard_count),
+        '_expiry_index': lambda self: IOBTree(),
+        '_consumer_token_map': lambda self: OOBTree(),
+        '_consumer_access_count': lambda self: OOBTree(),
+        '_timestamp_index': lambda self: IOBTree(),
+        '_last_used': lambda self: OOBTree(),
+    }
+
+    def __getattr__(self, name):
+        # only called for the attributes not found otherwise.
+        factory = TokenManager._added_trees.get(name, None)
+        if factory is None:
+            raise AttributeError(name)
+        tree = factory(self)
+        setattr(self, name, tree)
+        return tree
+
     def _makeDummy(self):
         dummy = Token(self.DUMMY_KEY, self.DUMMY_SECRET)
         return dummy
 
+    def _userTokens(self, user):
+        """\
+        Return the tree of the keys of the access tokens of the user to
+        their summaries, converting the sequence of keys kept by the
+        earlier versions.
+        """
+
+        user_tokens = self._user_token_map.get(user, None)
+        if user_tokens is None or isinstance(user_tokens, OOBTree):
+            return user_tokens
+
+        converted = OOBTree()
+        for key in user_tokens:
+            token = self._tokens.get(key, None)
+            if token is None:
+                continue
+            converted[key] = (token.consumer_key, token.timestamp)
+        self._user_token_map[user] = converted
+        return converted
+
     def _add_user_map(self, token):
         if not token.access or token.user is None:
             return
 
-        # only tracking access tokens with user defined.
-        user_tokens = self._user_token_map.get(token.user, None)
+        # only tracking access tokens with user defined, along with the
+        # summary needed for listing them without loading the tokens.
+        user_tokens = self._userTokens(token.user)
         if user_tokens is None:
-            user_tokens = PersistentList()
+            user_tokens = OOBTree()
             self._user_token_map[token.user] = user_tokens
 
-        user_tokens.append(token.key)
+        user_tokens[token.key] = (token.consumer_key, token.timestamp)
 
     def _del_user_map(self, token):
         if token.user is None:
             return
 
         # only tracking access tokens with user defined.
-        user_tokens = self._user_token_map.get(token.user, None)
+        user_tokens = self._userTokens(token.user)
         if user_tokens is None:
             # guess this user didn't have any tokens tracked before.
             return
 
         if token.key in user_tokens:
             # Well this key may not have been mapped.
-            user_tokens.remove(token.key)
+            del user_tokens[token.key]
+
+    def _expiry_bucket(self, expiry):
+        return int(expiry) // self.expiry_bucket_size
+
+    def _add_expiry_index(self, token):
+        if token.access or token.expiry is None:
+            return
+
+        # only tracking request tokens, as they are the ones that will
+        # be abandoned.
+        bucket = self._expiry_bucket(token.expiry)
+        keys = self._expiry_index.get(bucket, None)
+        if keys is None:
+            keys = OOTreeSet()
+            self._expiry_index[bucket] = keys
+
+        keys.insert(token.key)
+
+    def _del_expiry_index(self, key, expiry):
+        if expiry is None:
+            return
+        self._unindex_expiry_bucket(key, self._expiry_bucket(expiry))
+
+    def _unindex_expiry_bucket(self, key, bucket):
+        keys = self._expiry_index.get(bucket, None)
+        if keys is None:
+            return
+
+        if key in keys:
+            keys.remove(key)
+        if not keys:
+            del self._expiry_index[bucket]
+
+    def _add_consumer_map(self, token):
+        # Only the access tokens are indexed, the request tokens are
+        # short lived and are left to expire.
+        if not token.access or token.consumer_key is None:
+            return
+
+        keys = self._consumer_token_map.get(token.consumer_key, None)
+        if keys is None:
+            keys = OOTreeSet()
+            self._consumer_token_map[token.consumer_key] = keys
+
+        if keys.insert(token.key):
+            count = self._consumer_access_count.get(token.consumer_key, None)
+            if count is None:
+                count = Length()
+                self._consumer_access_count[token.consumer_key] = count
+            count.change(1)
+
+    def _del_consumer_map(self, token):
+        if not token.access:
+            return
+
+        keys = self._consumer_token_map.get(token.consumer_key, None)
+        if keys is None:
+            return
+
+        if token.key in keys:
+            keys.remove(token.key)
+            count = self._consumer_access_count.get(token.consumer_key, None)
+            if count is not None:
+                count.change(-1)
+        if not keys:
+            del self._consumer_token_map[token.consumer_key]
+            self._consumer_access_count.pop(token.consumer_key, None)
+
+    def _add_timestamp_index(self, token):
+        if not token.access or token.timestamp is None:
+            return
+
+        bucket = self._expiry_bucket(token.timestamp)
+        keys = self._timestamp_index.get(bucket, None)
+        if keys is None:
+            keys = OOTreeSet()
+            self._timestamp_index[bucket] = keys
+
+        keys.insert(token.key)
+
+    def _del_timestamp_index(self, token):
+        if token.timestamp is None:
+            return
+
+        bucket = self._expiry_bucket(token.timestamp)
+        keys = self._timestamp_index.get(bucket, None)
+        if keys is None:
+            return
+
+        if token.key in keys:
+            keys.remove(token.key)
+        if not keys:
+            del self._timestamp_index[bucket]
 
     def add(self, token):
         assert IToken.providedBy(token)
         if self.get(token.key):
             raise ValueError('token %s already exists', token.key)
-        self._tokens[token.key] = token
+        if self.compact and not isinstance(token, TokenRecord):
+            token = TokenRecord.fromToken(token)
+        self._tree(token)[token.key] = token
         self._add_user_map(token)
+        self._add_expiry_index(token)
+        self._add_consumer_map(token)
+        self._add_timestamp_index(token)
+        forgetUnknownKey('access_token', token.key)
+        return token
 
     def _generateBaseToken(self, consumer_key):
         key = random_string(24)
@@ -105,8 +410,7 @@ class TokenManager(Persistent, Contained):
 
         token.expiry = int(time.time()) + self.claim_timeout
 
-        self.add(token)
-        return token
+        return self.add(token)
 
     def generateAccessToken(self, consumer_key, request_token):
 
@@ -125,8 +429,7 @@ class TokenManager(Persistent, Contained):
         token.user = old_token.user
 
         # Now add token.
-        self.add(token)
-        return token
+        return self.add(token)
 
     def claimRequestToken(self, token, user):
         token = self.get(token)
@@ -134,16 +437,39 @@ class TokenManager(Persistent, Contained):
             raise TokenInvalidError('invalid token')
         if token.access:
             raise TokenInvalidError('not request token')
-        token.user = user
-        token.expiry = int(time.time()) + self.claim_timeout
+        self._del_expiry_index(token.key, token.expiry)
+        expiry = int(time.time()) + self.claim_timeout
+        if isinstance(token, TokenRecord):
+            # records are immutable, replace with the updated one.
+            token = token._replace(user=user, expiry=expiry)
+            self._tree(token)[token.key] = token
+        else:
+            token.user = user
+            token.expiry = expiry
+        self._add_expiry_index(token)
+
+    def _tree(self, token):
+        # the dummy is kept along with the access tokens.
+        if token.access or token.key == self.DUMMY_KEY:
+            return self._tokens
+        return self._request_tokens
 
     def get(self, token, default=None):
         token_key = IToken.providedBy(token) and token.key or token
-        return self._tokens.get(token_key, default)
+        result = self._tokens.get(token_key, None)
+        if result is None:
+            result = self._request_tokens.get(token_key, default)
+        return result
 
     def getRequestToken(self, token, default=False):
-        token = self.get(token, default)
-        if token is default:
+        token_key = IToken.providedBy(token) and token.key or token
+        token = self._request_tokens.get(token_key, None)
+        if token is not None:
+            return token
+
+        # Not found, but the other tree is checked for the error.
+        token = self._tokens.get(token_key, None)
+        if token is None:
             if default is False:
                 raise TokenInvalidError('no such request token.')
             return default
@@ -156,8 +482,13 @@ class TokenManager(Persistent, Contained):
         return token
 
     def getAccessToken(self, token, default=False):
-        token = self.get(token, default)
-        if token is default:
+        token_key = IToken.providedBy(token) and token.key or token
+        token = self._tokens.get(token_key, None)
+        if token is None:
+            if self._request_tokens.get(token_key, None) is not None:
+                if default is False:
+                    raise NotAccessTokenError('not an access token.')
+                return default
             if default is False:
                 raise TokenInvalidError('no such access token.')
             return default
@@ -185,13 +516,223 @@ class TokenManager(Persistent, Contained):
         result = [self.get(t) for t in raw_keys]
         return result
 
+    def getTokenPageForUser(self, user, start=None, batch_size=50):
+        user_tokens = self._userTokens(user)
+        if user_tokens is None:
+            return [], None
+        if start is None:
+            items = user_tokens.items()
+        else:
+            items = user_tokens.items(min=start, excludemin=True)
+
+        summaries = []
+        for key, (consumer_key, timestamp) in items:
+            if len(summaries) == batch_size:
+                return summaries, summaries[-1]['key']
+            summaries.append({
+                'key': key,
+                'consumer_key': consumer_key,
+                'timestamp': timestamp,
+            })
+        return summaries, None
+
+    def getTokensForConsumer(self, consumer_key):
+        raw_keys = self._consumer_token_map.get(consumer_key, [])
+        result = [self.get(t) for t in raw_keys]
+        return [t for t in result if t is not None and t.access]
+
+    def countTokensForConsumer(self, consumer_key):
+        count = self._consumer_access_count.get(consumer_key, None)
+        if count is None:
+            return 0
+        return count()
+
     def remove(self, token):
         if IToken.providedBy(token):
             token = token.key
-        token = self._tokens.pop(token)
+        if token in self._request_tokens:
+            token = self._request_tokens.pop(token)
+        else:
+            token = self._tokens.pop(token)
         self._del_user_map(token)
+        self._del_expiry_index(token.key, token.expiry)
+        self._del_consumer_map(token)
+        self._del_timestamp_index(token)
+        if token.key in self._last_used:
+            del self._last_used[token.key]
+        forgetHMACContext(token.consumer_key, token.key)
         return token
 
+    def removeTokens(self, keys):
+        """\
+        Remove the tokens identified by keys, ignoring the ones that do
+        not exist.  Returns the list of keys of the removed tokens.
+        """
+
+        removed = []
+        for key in keys:
+            if key == self.DUMMY_KEY or self.get(key) is None:
+                continue
+            self.remove(key)
+            removed.append(key)
+        return removed
+
+    def _limited(self, keys, limit):
+        result = []
+        for key in keys:
+            if limit is not None and len(result) >= limit:
+                break
+            result.append(key)
+        return result
+
+    def revokeTokensForConsumer(self, consumer_key, limit=None):
+        """\
+        Remove the access tokens issued to the consumer, up to limit
+        number of tokens if specified.  Returns the list of keys removed.
+        """
+
+        keys = self._consumer_token_map.get(consumer_key, ())
+        return self.removeTokens(self._limited(keys, limit))
+
+    def revokeTokensForUser(self, user, limit=None):
+        """\
+        Remove the access tokens of the user, up to limit number of
+        tokens if specified.  Returns the list of keys removed.
+        """
+
+        keys = self._user_token_map.get(user, ())
+        return self.removeTokens(self._limited(keys, limit))
+
+    def revokeTokensBefore(self, timestamp, limit=None):
+        """\
+        Remove the access tokens created before timestamp, up to limit
+        number of tokens if specified.  Returns the list of keys removed.
+        """
+
+        keys = []
+        for bucket in list(self._timestamp_index.keys(
+                max=self._expiry_bucket(timestamp))):
+            for key in self._timestamp_index.get(bucket, ()):
+                if limit is not None and len(keys) >= limit:
+                    return self.removeTokens(keys)
+                token = self._tokens.get(key, None)
+                if token is not None and token.timestamp < timestamp:
+                    keys.append(key)
+        return self.removeTokens(keys)
+
+    def compactTokens(self, start=None, limit=None):
+        """\
+        Convert the stored tokens with keys following start into
+        TokenRecords, up to limit number of tokens, and have the tokens
+        added from now on stored as records.
+
+        Returns the key to continue from, or None if the end was
+        reached.
+        """
+
+        self.compact = True
+        next_start = None
+        for tree in (self._tokens, self._request_tokens):
+            if start is None:
+                keys = tree.keys()
+            else:
+                keys = tree.keys(min=start, excludemin=True)
+
+            keys = self._limited(keys, limit)
+            for key in keys:
+                token = tree[key]
+                if not isinstance(token, TokenRecord):
+                    tree[key] = TokenRecord.fromToken(token)
+
+            if limit is not None and len(keys) == limit:
+                # continue from the tree that is behind, as the ones
+                # converted already will be skipped.
+                if next_start is None or keys[-1] < next_start:
+                    next_start = keys[-1]
+        return next_start
+
+    def recordUsage(self, token_key, timestamp=None):
+        if timestamp is None:
+            timestamp = int(time.time())
+        token_usage.record(self._last_used, token_key, timestamp)
+
+    def getLastUsed(self, token_key):
+        """\
+        Return the time the access token was last used, including the
+        usage not yet flushed, or None if never used.
+        """
+
+        pending = token_usage.get(self._last_used, token_key)
+        return max(pending, self._last_used.get(token_key, None))
+
+    def getIdleTokens(self, timestamp, limit=None):
+        """\
+        Return the keys of the access tokens that were neither created
+        nor used since timestamp, up to limit number of keys.
+        """
+
+        keys = []
+        last_bucket = self._expiry_bucket(timestamp)
+        for bucket in list(self._timestamp_index.keys(max=last_bucket)):
+            for key in self._timestamp_index.get(bucket, ()):
+                if limit is not None and len(keys) >= limit:
+                    return keys
+                if bucket == last_bucket:
+                    # only the tokens in the last bucket may have been
+                    # created after the timestamp.
+                    token = self._tokens.get(key, None)
+                    if token is None or token.timestamp >= timestamp:
+                        continue
+                last_used = self.getLastUsed(key)
+                if last_used is None or last_used < timestamp:
+                    keys.append(key)
+        return keys
+
+    def revokeIdleTokens(self, timestamp, limit=None):
+        """\
+        Remove the access tokens that were neither created nor used
+        since timestamp.  Returns the list of keys removed.
+        """
+
+        return self.removeTokens(self.getIdleTokens(timestamp, limit))
+
+    def purgeExpiredTokens(self, timestamp=None, limit=None):
+        """\
+        Remove the request tokens that have expired by timestamp, which
+        defaults to the current time.  At most limit tokens are removed
+        if it is specified.
+
+        Returns the list of keys of the removed tokens, so that any
+        associated data (such as the pending scope) can be purged too.
+        """
+
+        if timestamp is None:
+            timestamp = int(time.time())
+
+        removed = []
+        # Only the buckets up to the current one can hold expired keys.
+        buckets = list(self._expiry_index.keys(
+            max=self._expiry_bucket(timestamp)))
+
+        for bucket in buckets:
+            for key in list(self._expiry_index.get(bucket, ())):
+                if limit is not None and len(removed) >= limit:
+                    return removed
+
+                token = self._request_tokens.get(key, None)
+                if token is None or token.access:
+                    # Stale index entry, don't let it linger.
+                    self._unindex_expiry_bucket(key, bucket)
+                    continue
+
+                if token.expiry is None or token.expiry > timestamp:
+                    continue
+
+                self.remove(key)
+                removed.append(key)
+
+        return removed
+
     def requestTokenVerify(self, consumer_key, token, verifier):
         """\
         Verify that the request results in a valid token by checking for
@@ -207,6 +748,217 @@ class TokenManager(Persistent, Contained):
 TokenManagerFactory = factory(TokenManager)
 
 
+class KeyValueTokenManager(object):
+    """\
+    Token manager that keeps the request tokens (and so their verifiers)
+    in the IKeyValueStore utility until they expire, with everything
+    else handled by the persistent token manager of the site.
+
+    The request tokens are short lived and are looked up and written a
+    number of times before being exchanged, so this keeps the ZODB write
+    traffic for them out.  Request tokens already in the persistent
+    token manager remain usable.
+    """
+
+    zope.component.adapts(IAttributeAnnotatable, IKeyValueStoreLayer)
+    zope.interface.implements(ITokenManager)
+
+    # the token fields stored.
+    fields = ('key', 'secret', 'callback', 'verifier', 'user',
+        'consumer_key', 'timestamp', 'expiry')
+
+    def __init__(self, context, request):
+        self.context = context
+        self.request = request
+        self.tokens = TokenManagerFactory(context, request)
+        self.store = zope.component.getUtility(IKeyValueStore)
+        self.prefix = '/'.join(getattr(context, 'getPhysicalPath',
+            lambda: ('',))())
+
+    @property
+    def DUMMY_KEY(self):
+        return self.tokens.DUMMY_KEY
+
+    @property
+    def DUMMY_SECRET(self):
+        return self.tokens.DUMMY_SECRET
+
+    @property
+    def claim_timeout(self):
+        return self.tokens.claim_timeout
+
+    def _storeKey(self, key):
+        return storeKey('request_token', self.prefix, key)
+
+    def _dumps(self, token):
+        return json.dumps(dict([(f, getattr(token, f)) for f in self.fields]))
+
+    def _loads(self, value):
+        data = json.loads(value)
+        token = Token(str(data['key']), str(data['secret']))
+        for f in self.fields[2:]:
+            v = data.get(f)
+            if isinstance(v, unicode):
+                v = str(v)
+            setattr(token, f, v)
+        return token
+
+    def _ttl(self, token):
+        return max(token.expiry - int(time.time()), 1)
+
+    def _storeToken(self, token):
+        self.store.set(self._storeKey(token.key), self._dumps(token),
+            self._ttl(token))
+
+    def _getStored(self, key):
+        value = self.store.get(self._storeKey(key))
+        if value is None:
+            return None
+        return self._loads(value)
+
+    def add(self, token):
+        assert IToken.providedBy(token)
+        if token.access or token.expiry is None:
+            return self.tokens.add(token)
+        if self.get(token.key):
+            raise ValueError('token %s already exists', token.key)
+        if not self.store.add(self._storeKey(token.key), self._dumps(token),
+                self._ttl(token)):
+            raise ValueError('token %s already exists', token.key)
+        return token
+
+    def generateRequestToken(self, consumer_key, callback):
+        if callback is None:
+            raise CallbackValueError(
+                'callback must be specified or set to `oob`')
+
+        token = self.tokens._generateBaseToken(consumer_key)
+        token.set_callback(callback)
+        token.set_verifier()
+        token.expiry = int(time.time()) + self.claim_timeout
+        self.add(token)
+        return token
+
+    def generateAccessToken(self, consumer_key, request_token):
+        old_token = self.get(request_token)
+        if not old_token:
+            raise TokenInvalidError('invalid token')
+
+        token = self.tokens._generateBaseToken(consumer_key)
+        token.access = True
+        if not old_token.user:
+            raise TokenInvalidError('token has no user')
+        token.user = old_token.user
+
+        return self.tokens.add(token)
+
+    def claimRequestToken(self, token, user):
+        key = IToken.providedBy(token) and token.key or token
+        stored = self._getStored(key)
+        if stored is None:
+            return self.tokens.claimRequestToken(token, user)
+        stored.user = user
+        stored.expiry = int(time.time()) + self.claim_timeout
+        self._storeToken(stored)
+        if IToken.providedBy(token):
+            # keep the caller's copy consistent.
+            token.user = stored.user
+            token.expiry = stored.expiry
+
+    def get(self, token, default=None):
+        token_key = IToken.providedBy(token) and token.key or token
+        if token_key is None:
+            return default
+        stored = self._getStored(token_key)
+        if stored is not None:
+            return stored
+        return self.tokens.get(token_key, default)
+
+    def getRequestToken(self, token, default=False):
+        token_key = IToken.providedBy(token) and token.key or token
+        stored = token_key is not None and self._getStored(token_key)
+        if stored:
+            return stored
+        return self.tokens.getRequestToken(token, default)
+
+    def getAccessToken(self, token, default=False):
+        # The access tokens are all persisted, only look at the store
+        # for the correct error.
+        result = self.tokens.getAccessToken(token, None)
+        if result is not None:
+            return result
+        token_key = IToken.providedBy(token) and token.key or token
+        if token_key is not None and self._getStored(token_key):
+            if default is False:
+                raise NotAccessTokenError('not an access token.')
+            return default
+        return self.tokens.getAccessToken(token, default)
+
+    def hasTokensForUser(self, user):
+        return self.tokens.hasTokensForUser(user)
+
+    def getTokensForUser(self, user):
+        return self.tokens.getTokensForUser(user)
+
+    def remove(self, token):
+        token_key = IToken.providedBy(token) and token.key or token
+        stored = self._getStored(token_key)
+        if stored is not None:
+            self.store.delete(self._storeKey(token_key))
+            return stored
+        return self.tokens.remove(token)
+
+    def purgeExpiredTokens(self, timestamp=None, limit=None):
+        # The store expires its own.
+        return self.tokens.purgeExpiredTokens(timestamp, limit)
+
+    # The request tokens in the store are left to expire on their own,
+    # as they cannot be exchanged once the consumer or user is gone.
+
+    def getTokenPageForUser(self, user, start=None, batch_size=50):
+        return self.tokens.getTokenPageForUser(user, start, batch_size)
+
+    def getTokensForConsumer(self, consumer_key):
+        return self.tokens.getTokensForConsumer(consumer_key)
+
+    def countTokensForConsumer(self, consumer_key):
+        return self.tokens.countTokensForConsumer(consumer_key)
+
+    def removeTokens(self, keys):
+        return self.tokens.removeTokens(keys)
+
+    def revokeTokensForConsumer(self, consumer_key, limit=None):
+        return self.tokens.revokeTokensForConsumer(consumer_key, limit)
+
+    def revokeTokensForUser(self, user, limit=None):
+        return self.tokens.revokeTokensForUser(user, limit)
+
+    def revokeTokensBefore(self, timestamp, limit=None):
+        return self.tokens.revokeTokensBefore(timestamp, limit)
+
+    def compactTokens(self, start=None, limit=None):
+        return self.tokens.compactTokens(start, limit)
+
+    def recordUsage(self, token_key, timestamp=None):
+        return self.tokens.recordUsage(token_key, timestamp)
+
+    def getLastUsed(self, token_key):
+        return self.tokens.getLastUsed(token_key)
+
+    def getIdleTokens(self, timestamp, limit=None):
+        return self.tokens.getIdleTokens(timestamp, limit)
+
+    def revokeIdleTokens(self, timestamp, limit=None):
+        return self.tokens.revokeIdleTokens(timestamp, limit)
+
+    def requestTokenVerify(self, consumer_key, token, verifier):
+        token = self.getRequestToken(token)
+        return (token.consumer_key == consumer_key and
+                token.verifier == verifier and
+                token.user is not None
+                )
+
+
 class Token(Persistent):
 
     zope.interface.implements(IToken)
@@ -262,14 +1014,71 @@ class Token(Persistent):
         Based on implementation from python-oauth2, with corrections.
         """
 
-        if self.callback and self.verifier:
-            # Append the oauth_verifier.
-            parts = urlparse.urlparse(self.callback)
-            scheme, netloc, path, params, query, fragment = parts[:6]
-            q = query and [query] or []
-            q.append('oauth_verifier=%s' % self.verifier)
-            q.append('oauth_token=%s' % self.key)
-            query = '&'.join(q)
-            return urlparse.urlunparse((scheme, netloc, path, params,
-                query, fragment))
-        return self.callback
+        return callbackURL(self)
+
+
+def callbackURL(token):
+    if token.callback and token.verifier:
+        # Append the oauth_verifier.
+        parts = urlparse.urlparse(token.callback)
+        scheme, netloc, path, params, query, fragment = parts[:6]
+        q = query and [query] or []
+        q.append('oauth_verifier=%s' % token.verifier)
+        q.append('oauth_token=%s' % token.key)
+        query = '&'.join(q)
+        return urlparse.urlunparse((scheme, netloc, path, params,
+            query, fragment))
+    return token.callback
+
+
+class TokenRecord(tuple):
+    """\
+    Compact immutable token, stored inline within the buckets of the
+    token tree of the manager rather than as a persistent object of its
+    own, so that loading one does not cost another object load.
+
+    Use _replace to derive an updated record.
+    """
+
+    zope.interface.implements(IToken)
+
+    __slots__ = ()
+
+    fields = ('key', 'secret', 'callback', 'verifier', 'access', 'user',
+        'consumer_key', 'timestamp', 'expiry')
+
+    def __new__(cls, key, secret, callback=None, verifier=None,
+            access=False, user=None, consumer_key=None, timestamp=None,
+            expiry=None):
+        assert not ((key is None) or (secret is None))
+        return tuple.__new__(cls, (key, secret, callback, verifier,
+            access, user, consumer_key, timestamp, expiry))
+
+    @classmethod
+    def fromToken(cls, token):
+        return cls(*[getattr(token, f) for f in cls.fields])
+
+    def __reduce__(self):
+        return (self.__class__, tuple(self))
+
+    def __repr__(self):
+        return '<TokenRecord %r>' % (self[0],)
+
+    def _replace(self, **kw):
+        values = list(self)
+        for name, value in kw.items():
+            values[self.fields.index(name)] = value
+        return self.__class__(*values)
+
+    key = property(itemgetter(0))
+    secret = property(itemgetter(1))
+    callback = property(itemgetter(2))
+    verifier = property(itemgetter(3))
+    access = property(itemgetter(4))
+    user = property(itemgetter(5))
+    consumer_key = property(itemgetter(6))
+    timestamp = property(itemgetter(7))
+    expiry = property(itemgetter(8))
+
+    def get_callback_url(self):
+        return callbackURL(self)
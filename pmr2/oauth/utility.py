@@ -1,9 +1,15 @@
 import os
+import re
+import hmac
 import base64
-from urllib import quote_plus
+import logging
+from hashlib import sha1, sha256
+from urllib import quote_plus, unquote
+from urlparse import parse_qs
 
 import oauthlib.oauth1
 from oauthlib.common import urldecode
+from oauthlib.oauth1.rfc5849.utils import escape
 
 import zope.interface
 import zope.schema
@@ -17,10 +23,44 @@ from pmr2.oauth.interfaces import IOAuthRequestValidatorAdapter, INonceManager
 from pmr2.oauth.interfaces import IConsumerManager, ITokenManager
 from pmr2.oauth.interfaces import IScopeManager
 
+from pmr2.oauth.cache import getRequestManager, queryRequestManager
+from pmr2.oauth.cache import memoize, invalidate, LRUCache
+
 from pmr2.oauth.schema import buildSchemaInterface, CTSMMappingList
 
+try:
+    from cryptography.hazmat.primitives import hashes
+    from jwt.algorithms import RSAAlgorithm
+except ImportError:  # pragma: no cover
+    RSAAlgorithm = None
+
+logger = logging.getLogger('pmr2.oauth.utility')
+
 SAFE_ASCII_CHARS = set([chr(i) for i in xrange(32, 127)])
 
+# The consumer and access token keys recently found to be unknown by
+# this process, each mapped to the paths of the sites it is unknown to.
+# Keys created by this process are removed when added, the ones created
+# by other processes (e.g. other ZEO clients) once the entry expires.
+unknown_keys = LRUCache(maxsize=10000, ttl=300)
+
+# The RSA public keys parsed by this process, keyed by the consumer key
+# and the fingerprint of the key.
+rsa_keys = LRUCache(maxsize=1000)
+
+# The HMAC-SHA1 contexts prepared by this process, keyed by the consumer
+# and token keys, each along with the digest of the signing key it was
+# prepared with (the key itself is not kept).  The contexts are copied
+# for each signature computed.
+hmac_contexts = LRUCache(maxsize=10000)
+
+# The dummy consumers prepared by this process, keyed by the randomly
+# generated dummy key and secret of the consumer manager of each site.
+# These are never stored or modified.
+dummy_consumers = LRUCache(maxsize=1000)
+
+_auth_param_re = re.compile(r'(oauth_consumer_key|oauth_token)="([^"]*)"')
+
 
 class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
     """
@@ -34,24 +74,33 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
         # consider adapting self rather than site for these managers?
         # this might make it easier to provide a whole suite of managers
         # for a given validator.
-        self.consumerManager = zope.component.getMultiAdapter(
-            (site, request), IConsumerManager)
-        self.tokenManager = zope.component.getMultiAdapter(
-            (site, request), ITokenManager)
-        self.callbackManager = zope.component.getMultiAdapter(
-            (site, request), ICallbackManager)
+        self.consumerManager = getRequestManager(
+            site, request, IConsumerManager)
+        self.tokenManager = getRequestManager(site, request, ITokenManager)
+        self.callbackManager = getRequestManager(
+            site, request, ICallbackManager)
 
         # Really should not be optional, but this is only used within
         # the ``invalidate_request_token`` method
-        self.scopeManager = zope.component.queryMultiAdapter(
-            (site, request), IScopeManager)
+        self.scopeManager = queryRequestManager(site, request, IScopeManager)
 
         # Optional at this point.
-        self.nonceManager = zope.component.queryMultiAdapter(
-            (site, request), INonceManager)
+        self.nonceManager = queryRequestManager(site, request, INonceManager)
 
         self.access_key = None
 
+        # The token of the request for a protected resource, as set by
+        # the OAuth plugin.  Only this key is remembered as unknown if
+        # it is not an access token, rather than the other keys (e.g.
+        # the request tokens and dummies) looked up as access tokens.
+        self.resource_owner_key = None
+
+        # The dummies are prepared up front, such that the validations
+        # failing against them do no lookups beyond the ones done for
+        # the actual keys.
+        self.dummy_consumer = dummyConsumer(self.consumerManager)
+        self.dummy_token = unicode(self.tokenManager.DUMMY_KEY)
+
         self.site = site
         self.request = request
 
@@ -66,8 +115,9 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
             u'Authorization': safe_unicode(request._auth),
         }
 
-        request.stdin.seek(0)
-        self.body = safe_unicode(request.stdin.read())
+    @property
+    def body(self):
+        return extractRequestBody(self.request)
 
     def mark_request(self, oauth_request):
         """
@@ -77,6 +127,34 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
 
         self.request._pmr2_oauth1_ = oauth_request
 
+    # Lookups memoized for the duration of the request, as the same
+    # token and consumer are looked up a number of times by oauthlib.
+
+    def getConsumer(self, client_key, default=None):
+        consumer = memoize(self.request, ('consumer', client_key),
+            self.consumerManager.getValidated, client_key)
+        if consumer is None:
+            markUnknownKey(self.site, 'consumer', client_key)
+            return default
+        return consumer
+
+    def getRequestToken(self, request_token, default=None):
+        token = memoize(self.request, ('request_token', request_token),
+            self.tokenManager.getRequestToken, request_token, None)
+        if token is None:
+            return default
+        return token
+
+    def getAccessToken(self, access_token, default=None):
+        token = memoize(self.request, ('access_token', access_token),
+            self.tokenManager.getAccessToken, access_token, None)
+        if token is None:
+            if (access_token == self.resource_owner_key and
+                    access_token != self.dummy_token):
+                markUnknownKey(self.site, 'access_token', access_token)
+            return default
+        return token
+
     # Property overrides
 
     @property
@@ -117,23 +195,17 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
 
     @property
     def dummy_request_token(self):
-        token = self.tokenManager.get(self.tokenManager.DUMMY_KEY)
-        result = token and token.key or self.tokenManager.DUMMY_KEY
-        return unicode(result)
+        return self.dummy_token
 
     @property
     def dummy_access_token(self):
-        token = self.tokenManager.get(self.tokenManager.DUMMY_KEY)
-        result = token and token.key or self.tokenManager.DUMMY_KEY
-        return unicode(result)
+        return self.dummy_token
 
     # Implementation
 
     def get_client_secret(self, client_key, request):
-        consumer = self.consumerManager.getValidated(client_key)
-        # Spend actual time failing.
-        dummy = self.consumerManager.getValidated(
-            self.consumerManager.DUMMY_KEY)
+        # The unknown keys cost the same single lookup as the known ones.
+        consumer = self.getConsumer(client_key)
 
         if consumer:
             result = consumer.secret
@@ -143,7 +215,7 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
         return unicode(result)
 
     def get_request_token_secret(self, client_key, request_token, request):
-        token = self.tokenManager.getRequestToken(request_token, None)
+        token = self.getRequestToken(request_token)
         if token and token.consumer_key == client_key:
             result = token.secret
         else:
@@ -152,7 +224,7 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
         return unicode(result)
 
     def get_access_token_secret(self, client_key, access_token, request):
-        token = self.tokenManager.getAccessToken(access_token, None)
+        token = self.getAccessToken(access_token)
         if token and token.consumer_key == client_key:
             result = token.secret
         else:
@@ -171,8 +243,10 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
         raise NotImplementedError
 
     def get_rsa_key(self, client_key, request):
-        # TODO figure out how to implement this.
-        raise NotImplementedError
+        consumer = self.getConsumer(client_key)
+        if consumer is None:
+            return None
+        return parseRSAKey(consumer.key, consumer.rsa_key)
 
     def invalidate_request_token(self, client_key, request_token, request):
         # purge the scope
@@ -182,32 +256,35 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
         token = self.tokenManager.getRequestToken(request_token, None)
         if token:
             self.tokenManager.remove(token)
+        invalidate(self.request, ('request_token', request_token))
 
     def validate_client_key(self, client_key, request):
-        # This will search through the table to acquire a failed dummy key
-        dummy = self.consumerManager.get(self.consumerManager.DUMMY_KEY,
-            self.consumerManager.makeDummy())
-        consumer = self.consumerManager.getValidated(client_key, dummy)
-        return consumer.validate() and consumer != dummy
+        dummy = self.dummy_consumer
+        consumer = self.getConsumer(client_key, dummy)
+        return consumer.validate() and consumer is not dummy
 
     def validate_request_token(self, client_key, request_token, request):
         # XXX request_token <- token in parent
-        token = self.tokenManager.getRequestToken(request_token, 
-            self.dummy_request_token)
-        return (token != self.dummy_request_token and 
-            token.consumer_key == client_key)
+        dummy = self.dummy_token
+        token = self.getRequestToken(request_token, dummy)
+        return token is not dummy and token.consumer_key == client_key
 
     def validate_access_token(self, client_key, access_token, request):
-        token = self.tokenManager.getAccessToken(access_token, 
-            self.dummy_access_token)
-        return (token != self.dummy_access_token and 
-            token.consumer_key == client_key)
+        dummy = self.dummy_token
+        token = self.getAccessToken(access_token, dummy)
+        return token is not dummy and token.consumer_key == client_key
 
     def validate_timestamp_and_nonce(self, client_key, timestamp, nonce,
             request, request_token=None, access_token=None):
         if self.nonceManager:
-            # TODO figure out the parameters.
-            return self.nonceManager.validate(timestamp, nonce)
+            token = request_token or access_token
+            # oauthlib may validate the same request more than once, so
+            # the result is memoized for this request so that it won't
+            # be seen as a replay of itself.
+            return memoize(self.request,
+                ('nonce', client_key, timestamp, nonce, token),
+                self.nonceManager.check, client_key, timestamp, nonce,
+                token, self.request)
         # Just let this one go...
         return True
 
@@ -219,7 +296,7 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
             return True
 
         # Only the token request will have this
-        consumer = self.consumerManager.getValidated(client_key)
+        consumer = self.getConsumer(client_key)
         return self.callbackManager.validate(consumer, redirect_uri)
 
     def validate_requested_realms(self, client_key, realms, request):
@@ -251,6 +328,145 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
         return
 
 
+def sitePrefix(site):
+    getPhysicalPath = getattr(site, 'getPhysicalPath', None)
+    if getPhysicalPath is None:
+        return None
+    return '/'.join(getPhysicalPath())
+
+def markUnknownKey(site, kind, key):
+    """
+    Note that the key of this kind ('consumer' or 'access_token') is
+    unknown to the site.
+    """
+
+    if not key:
+        return
+    prefixes = unknown_keys.get((kind, key), frozenset())
+    unknown_keys.set((kind, key), prefixes | frozenset([sitePrefix(site)]))
+
+def isUnknownKey(site, kind, key):
+    if not key:
+        return False
+    return sitePrefix(site) in unknown_keys.get((kind, key), ())
+
+def forgetUnknownKey(kind, key):
+    """
+    Called when a key of this kind is added to any site.
+    """
+
+    unknown_keys.pop((kind, key), None)
+
+def extractOAuthKeys(request):
+    """
+    Return the consumer key and token in the OAuth parameters of the
+    request, from the Authorization header or the query string, without
+    parsing or validating anything else.
+    """
+
+    auth = request._auth
+    if auth and auth.startswith('OAuth '):
+        params = dict([(k, unquote(v))
+            for k, v in _auth_param_re.findall(auth)])
+    else:
+        params = dict([(k, v[0]) for k, v in
+            parse_qs(request.get('QUERY_STRING', '')).items()])
+
+    return (safe_unicode(params.get('oauth_consumer_key')),
+        safe_unicode(params.get('oauth_token')))
+
+def parseRSAKey(consumer_key, rsa_key):
+    """
+    Return the parsed form of the PEM encoded RSA public key of the
+    consumer, or None if it is missing or cannot be parsed.
+    """
+
+    if not rsa_key:
+        return None
+
+    if RSAAlgorithm is None:
+        logger.warning('RSA-SHA1 signatures require `pmr2.oauth [rsa]`')
+        return None
+
+    if isinstance(rsa_key, unicode):
+        rsa_key = rsa_key.encode('utf-8')
+
+    key = (consumer_key, sha1(rsa_key).hexdigest())
+    result = rsa_keys.get(key)
+    if result is None:
+        result = _prepareRSAKey(rsa_key)
+        if result is None:
+            logger.warning('invalid RSA public key for consumer `%s`',
+                consumer_key)
+            result = False
+        rsa_keys.set(key, result)
+
+    return result or None
+
+def _prepareRSAKey(rsa_key):
+    if isinstance(rsa_key, unicode):
+        rsa_key = rsa_key.encode('utf-8')
+    try:
+        return RSAAlgorithm(hashes.SHA1).prepare_key(rsa_key)
+    except Exception:
+        return None
+
+def checkRSAKey(rsa_key):
+    """
+    Return whether the PEM encoded RSA public key can be parsed.  Keys
+    are accepted unchecked if RSA-SHA1 signatures are not supported by
+    this installation.
+    """
+
+    if not rsa_key or RSAAlgorithm is None:
+        return True
+    return _prepareRSAKey(rsa_key) is not None
+
+def dummyConsumer(consumerManager):
+    """
+    Return the dummy consumer of the consumer manager, constructed once
+    per process.
+    """
+
+    key = (consumerManager.DUMMY_KEY, consumerManager.DUMMY_SECRET)
+    result = dummy_consumers.get(key)
+    if result is None:
+        result = consumerManager.makeDummy()
+        dummy_consumers.set(key, result)
+    return result
+
+def hmacContext(client_key, token_key, client_secret, resource_owner_secret):
+    """
+    Return a fresh HMAC-SHA1 context keyed with the secrets, as defined
+    by section 3.4.2 of RFC 5849, copied from the one prepared for the
+    consumer and token pair.
+    """
+
+    key = (escape(client_secret or u'') + u'&' +
+        escape(resource_owner_secret or u'')).encode('utf-8')
+    digest = sha256(key).digest()
+    cached = hmac_contexts.get((client_key, token_key))
+    if cached is None or cached[0] != digest:
+        # the secrets differ (e.g. the dummy ones), prepare another.
+        cached = (digest, hmac.new(key, None, sha1))
+        hmac_contexts.set((client_key, token_key), cached)
+    return cached[1].copy()
+
+def forgetHMACContext(client_key, token_key=None):
+    """
+    Called when a consumer or a token is removed.  The contexts of all
+    the tokens of the consumer are forgotten along with the consumer.
+    """
+
+    if token_key is not None:
+        hmac_contexts.pop((client_key, token_key), None)
+        return
+
+    # Rare enough to not warrant an index by the consumer.
+    for key in hmac_contexts.keys():
+        if key[0] == client_key:
+            hmac_contexts.pop(key, None)
+
 def random_string(length):
     """
     Request a random string up to this length.
@@ -290,6 +506,27 @@ def extractRequestURL(request):
 
     return result
 
+def isFormEncoded(request):
+    content_type = request.getHeader('Content-type', None) or ''
+    return (content_type.split(';')[0].strip().lower() ==
+        'application/x-www-form-urlencoded')
+
+def _readRequestBody(request):
+    request.stdin.seek(0)
+    return safe_unicode(request.stdin.read())
+
+def extractRequestBody(request):
+    """
+    Return the body of the request if it is form encoded, as only then
+    it is included in the signature base string (RFC 5849 3.4.1.3.1),
+    otherwise an empty string without reading anything, so uploads are
+    not read into memory.  The body is only read once per request.
+    """
+
+    if not isFormEncoded(request):
+        return u''
+    return memoize(request, 'body', _readRequestBody, request)
+
 def safe_unicode(s):
     if isinstance(s, str):
         return unicode(s)
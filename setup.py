@@ -45,8 +45,14 @@ setup(name='pmr2.oauth',
           'test': [
               'z3c.form [test]',
           ],
+          'rsa': [
+              'pyjwt>=1.0.0',
+              'cryptography',
+          ],
       },
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      pmr2_oauth_benchmark = pmr2.oauth.benchmark:main
       """,
       )